@@ -0,0 +1,361 @@
+#
+#   Copyright 2022 Joshua Maglione
+#
+#   Distributed under MIT License
+#
+
+from array import array as _array
+
+# Iterates through the positions of the 1-bits of the integer m.
+def _bits(m):
+    while m:
+        low = m & -m
+        yield low.bit_length() - 1
+        m ^= low
+
+def _popcount(m):
+    return bin(m).count("1")
+
+# Builds CSR arrays (ptr, idx) from a list of lists of integers.
+def _csr(rows):
+    ptr = _array('l', [0])
+    idx = _array('l')
+    for r in rows:
+        idx.extend(r)
+        ptr.append(len(idx))
+    return ptr, idx
+
+
+# A compact description of a lattice of flats. Flats are stored by position,
+# sorted by rank, with the bottom element in position 0. Each flat is given as
+# an integer bitmask over the hyperplanes: bit j is set if and only if the
+# hyperplane labeled by hyperplanes[j] contains the flat. Cover relations are
+# stored in CSR arrays in both directions. The names of the flats (i.e. the
+# elements of the corresponding Sage poset) are given by elements.
+class CompactLattice():
+
+    def __init__(self, elements, ranks, masks, up, down, hyperplanes):
+        self.elements = elements
+        self.ranks = ranks
+        self.masks = masks
+        self.up_ptr, self.up_idx = up
+        self.down_ptr, self.down_idx = down
+        self.hyperplanes = hyperplanes
+        self.index = {elements[i] : i for i in range(len(elements))}
+        self._bit = None
+        self._mask_index = None
+        self._poincare = None
+        self._down_bits = None
+        self._up_bits = None
+        self._atom_bits = None
+
+    def __repr__(self):
+        return "A compact lattice of flats with {0} elements".format(len(self))
+
+    def __len__(self):
+        return len(self.elements)
+
+    @classmethod
+    def from_covers(cls, elements, covers, masks, hyperplanes):
+        r"""
+        Return the compact lattice with the given elements, cover relations
+        (pairs of elements), masks (a dictionary from the elements to integer
+        bitmasks), and hyperplanes. The elements are sorted by rank, and ties
+        are broken by the order of ``elements``.
+        """
+        elements = list(elements)
+        pos = {elements[i] : i for i in range(len(elements))}
+        n = len(elements)
+        up = [[] for _ in range(n)]
+        n_down = [0]*n
+        for a, b in covers:
+            up[pos[a]].append(pos[b])
+            n_down[pos[b]] += 1
+        # Ranks via a topological sort from the minimal elements.
+        ranks = [0]*n
+        stack = [i for i in range(n) if n_down[i] == 0]
+        while stack:
+            i = stack.pop()
+            for j in up[i]:
+                ranks[j] = max(ranks[j], ranks[i] + 1)
+                n_down[j] -= 1
+                if n_down[j] == 0:
+                    stack.append(j)
+        order = sorted(range(n), key=lambda i: (ranks[i], i))
+        new_pos = [0]*n
+        for k in range(n):
+            new_pos[order[k]] = k
+        up_rows = [sorted(new_pos[j] for j in up[i]) for i in order]
+        down_rows = [[] for _ in range(n)]
+        for k in range(n):
+            for j in up_rows[k]:
+                down_rows[j].append(k)
+        return cls(
+            [elements[i] for i in order],
+            _array('l', [ranks[i] for i in order]),
+            [masks[elements[i]] for i in order],
+            _csr(up_rows),
+            _csr(down_rows),
+            list(hyperplanes)
+        )
+
+    def bit(self, h):
+        if self._bit is None:
+            H = self.hyperplanes
+            self._bit = {H[j] : j for j in range(len(H))}
+        return self._bit[h]
+
+    def mask_of(self, labels):
+        m = 0
+        for h in labels:
+            m |= 1 << self.bit(h)
+        return m
+
+    def labels(self, m):
+        H = self.hyperplanes
+        return [H[j] for j in _bits(m)]
+
+    def position_of_mask(self, m):
+        if self._mask_index is None:
+            M = self.masks
+            self._mask_index = {M[i] : i for i in range(len(M))}
+        return self._mask_index.get(m)
+
+    def rank(self, i=None):
+        if i is None:
+            return max(self.ranks)
+        return self.ranks[i]
+
+    def upper_covers(self, i):
+        return list(self.up_idx[self.up_ptr[i]:self.up_ptr[i + 1]])
+
+    def lower_covers(self, i):
+        return list(self.down_idx[self.down_ptr[i]:self.down_ptr[i + 1]])
+
+    def atoms(self):
+        return self.upper_covers(0)
+
+    def maximal_elements(self):
+        ptr = self.up_ptr
+        return [i for i in range(len(self)) if ptr[i] == ptr[i + 1]]
+
+    def has_top(self):
+        return len(self.maximal_elements()) == 1
+
+    def top(self):
+        maxs = self.maximal_elements()
+        if len(maxs) != 1:
+            return None
+        return maxs[0]
+
+    def le(self, i, j):
+        return bool((self.down_bits(j) >> i) & 1)
+
+    # Builds the transitive closure of the cover relations as two lists of
+    # integer bitsets over the positions: bit j of down[i] is set if and only
+    # if j <= i, and bit j of up[i] is set if and only if i <= j. The positions
+    # are sorted by rank, so each bitset is the OR of the bitsets of the covers
+    # of the element, computed in one pass upwards and one pass downwards.
+    def _reachability(self):
+        if self._down_bits is None:
+            n = len(self)
+            down = [0]*n
+            for i in range(n):
+                b = 1 << i
+                for j in self.down_idx[self.down_ptr[i]:self.down_ptr[i + 1]]:
+                    b |= down[j]
+                down[i] = b
+            up = [0]*n
+            for i in reversed(range(n)):
+                b = 1 << i
+                for j in self.up_idx[self.up_ptr[i]:self.up_ptr[i + 1]]:
+                    b |= up[j]
+                up[i] = b
+            self._down_bits = down
+            self._up_bits = up
+        return self._down_bits, self._up_bits
+
+    def down_bits(self, i):
+        return self._reachability()[0][i]
+
+    def up_bits(self, i):
+        return self._reachability()[1][i]
+
+    def down_set(self, i):
+        return list(_bits(self.down_bits(i)))
+
+    def up_set(self, i):
+        return list(_bits(self.up_bits(i)))
+
+    def atoms_below(self, i):
+        r"""
+        Return the positions of the atoms below the element in position i.
+        """
+        if self._atom_bits is None:
+            self._atom_bits = sum(1 << a for a in self.atoms())
+        return list(_bits(self.down_bits(i) & self._atom_bits))
+
+    def sub(self, positions, masks=None, hyperplanes=None):
+        r"""
+        Return the compact lattice on the given (sorted) positions with the
+        induced cover relations. The ranks are shifted so that the first
+        position has rank 0. If masks are given, they are listed in the same
+        order as the positions.
+        """
+        new = {positions[k] : k for k in range(len(positions))}
+        up_rows = []
+        down_rows = []
+        for i in positions:
+            up_rows.append([new[j] for j in self.upper_covers(i) if j in new])
+            down_rows.append([new[j] for j in self.lower_covers(i) if j in new])
+        r0 = self.ranks[positions[0]]
+        if masks is None:
+            masks = [self.masks[i] for i in positions]
+        if hyperplanes is None:
+            hyperplanes = self.hyperplanes
+        return CompactLattice(
+            [self.elements[i] for i in positions],
+            _array('l', [self.ranks[i] - r0 for i in positions]),
+            masks,
+            _csr(up_rows),
+            _csr(down_rows),
+            hyperplanes
+        )
+
+    def cover_relations(self, positions=None):
+        E = self.elements
+        if positions is None:
+            return [
+                [E[i], E[j]] for i in range(len(self))
+                for j in self.upper_covers(i)
+            ]
+        keep = set(positions)
+        return [
+            [E[i], E[j]] for i in positions
+            for j in self.upper_covers(i) if j in keep
+        ]
+
+    def to_poset(self, positions=None):
+        from sage.all import Poset
+        if positions is None:
+            elts = self.elements
+        else:
+            elts = [self.elements[i] for i in positions]
+        CR = self.cover_relations(positions=positions)
+        return Poset((elts, CR), cover_relations=True)
+
+    def invariant(self, positions):
+        r"""
+        Return a cheap isomorphism invariant of the subposet on the given
+        (sorted) positions: the number of elements of each rank together with
+        the number of cover relations.
+        """
+        keep = set(positions)
+        r0 = self.ranks[positions[0]]
+        whitney = [0]*(self.ranks[positions[-1]] - r0 + 1)
+        n_covers = 0
+        for i in positions:
+            whitney[self.ranks[i] - r0] += 1
+            n_covers += sum(1 for j in self.upper_covers(i) if j in keep)
+        return tuple(whitney), n_covers
+
+    def certificate(self, positions):
+        r"""
+        Return a canonical certificate of the subposet on the given positions.
+        Two subposets are isomorphic if and only if their certificates agree.
+        """
+        from sage.all import DiGraph
+        new = {positions[k] : k for k in range(len(positions))}
+        edges = [
+            (new[i], new[j]) for i in positions 
+            for j in self.upper_covers(i) if j in new
+        ]
+        G = DiGraph()
+        G.add_vertices(range(len(positions)))
+        G.add_edges(edges)
+        return G.canonical_label().dig6_string()
+
+    # Returns the positions of the interval [i, z], assuming i <= z.
+    def interval(self, i, z):
+        return set(_bits(self.up_bits(i) & self.down_bits(z)))
+
+    def poincare_row(self, i):
+        r"""
+        Return a pair of dictionaries indexed by the elements z above i. The
+        first gives the Mobius function mu(i, z), and the second gives the
+        coefficients of the Poincare polynomial of the interval [i, z].
+        """
+        # The elements above i get local positions k in rank order, and bit l
+        # of below[k] is set if and only if up[l] <= up[k]. These bitsets are
+        # built in one pass over the lower covers, and the sums of mu over
+        # each interval [i, z] are read off from them by rank.
+        up = self.up_set(i)
+        local = {up[k] : k for k in range(len(up))}
+        r0 = self.ranks[i]
+        rank = [self.ranks[z] - r0 for z in up]
+        below = [0]*len(up)
+        m = [0]*len(up)
+        mu = {}
+        row = {}
+        for k in range(len(up)):
+            z = up[k]
+            b = 1 << k
+            for c in self.down_idx[self.down_ptr[z]:self.down_ptr[z + 1]]:
+                if c in local:
+                    b |= below[local[c]]
+            below[k] = b
+            sums = [0]*(rank[k] + 1)
+            for l in _bits(b ^ (1 << k)):
+                sums[rank[l]] += m[l]
+            m[k] = 1 if k == 0 else -sum(sums)
+            sums[rank[k]] += m[k]
+            mu[z] = m[k]
+            row[z] = [(-1)**r*sums[r] for r in range(len(sums))]
+        return mu, row
+
+    def poincare_arrays(self):
+        r"""
+        Return a pair (U, D) of NumPy arrays with one row for each position
+        x, padded with zeros to length rank + 1. Row x of U gives the
+        coefficients of the Poincare polynomial of the upper interval above x,
+        and row x of D the coefficients for the lower interval [0, x]. The
+        entries are Python integers, so the Mobius sums cannot overflow. The
+        arrays are computed once, in one pass each over the comparable pairs,
+        and cached.
+        """
+        if self._poincare is None:
+            import numpy
+            n = len(self)
+            r = self.rank()
+
+            # With Z the zeta matrix and F the matrix whose row y is the
+            # monomial (-Y)^rk(y), the solution G of Z*G = F is mu*F: row x of
+            # G is the sum of mu(x, y)*(-Y)^rk(y) over y >= x. Positions are
+            # sorted by rank, so we solve from the last position up. Only the
+            # strict up-set of x, read off its bitset, enters the sum for row
+            # x, and row x of G is stored from column rk(x) on, where it can
+            # be nonzero.
+            G = [None]*n
+            U = numpy.zeros((n, r + 1), dtype=object)
+            for i in reversed(range(n)):
+                k = self.ranks[i]
+                g = [0]*(r + 1 - k)
+                g[0] = (-1)**k
+                for j in _bits(self.up_bits(i) ^ (1 << i)):
+                    shift = self.ranks[j] - k
+                    for c, a in enumerate(G[j]):
+                        g[shift + c] -= a
+                G[i] = g
+                U[i, :r + 1 - k] = [(-1)**k*a for a in g]
+
+            # The lower intervals only need mu(0, y), and row y of D sums
+            # mu(0, w)*(-Y)^rk(w) over the down-set of y.
+            mu = [0]*n
+            D = numpy.zeros((n, r + 1), dtype=object)
+            for i in range(n):
+                below = list(_bits(self.down_bits(i) ^ (1 << i)))
+                mu[i] = 1 if i == 0 else -sum(mu[j] for j in below)
+                for j in below + [i]:
+                    D[i, self.ranks[j]] += (-1)**self.ranks[j]*mu[j]
+            self._poincare = (U, D)
+        return self._poincare
@@ -4,60 +4,187 @@
 #   Distributed under MIT License
 #
 
-from .Globals import __TIME as _time
+from .Globals import __DATABASE as _db_file
+import os as _os
+import sqlite3 as _sqlite3
+
+# Cheap isomorphism invariants of a compact lattice D: the size, the rank, the
+# number of atoms, and the Whitney numbers.
+def _invariants(D):
+    whitney, _ = D.invariant(list(range(len(D))))
+    atoms = whitney[1] if len(whitney) > 1 else 0
+    return tuple([len(D), D.rank(), atoms, ",".join(map(str, whitney))])
+
+# The key of the in-memory index: the invariants together with the
+# coefficients of the Poincare polynomial, which are cached with D.
+def _index_key(D):
+    pi = tuple(int(c) for c in D.poincare_arrays()[0][0])
+    return _invariants(D) + tuple([pi])
+
+# A canonical certificate of D: isomorphic lattices have equal certificates.
+# It is the certificate of the Hasse diagram, as for Sage posets.
+def _certificate(D):
+    return D.certificate(list(range(len(D))))
+
+
+# An SQLite file of generating functions, indexed by the canonical certificate
+# of the lattice. The invariants are stored as secondary columns, so that the
+# certificate is only computed when a lattice with the same invariants is known.
+# Several processes may read and write to the same file.
+class _DiskDatabase():
+
+    def __init__(self, file):
+        self.file = file
+        self._conn = None
+        self._pid = None
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS gen_funcs ("
+                "certificate TEXT, style TEXT, size INTEGER, rank INTEGER, "
+                "atoms INTEGER, whitney TEXT, gen_func BLOB, "
+                "PRIMARY KEY (certificate, style))"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS invariants ON gen_funcs "
+                "(size, rank, atoms, whitney, style)"
+            )
 
-# Given a list of posets L, a poset P, and an integer n, decide if L has a poset
-# isomorphic to P.
-def _check(L, P, n):
-    if len(L) == 0 or len(L) <= n:
-        return False, None
-    if L[n].is_isomorphic(P):
-        return True, n
-    return _check(L, P, n+1) 
+    def __repr__(self):
+        return "A database stored in %s" % (self.file)
+
+    # Connections cannot be shared with forked processes, so each process
+    # opens its own.
+    def _connection(self):
+        if self._conn is None or self._pid != _os.getpid():
+            self._conn = _sqlite3.connect(self.file, timeout=600)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._pid = _os.getpid()
+        return self._conn
+
+    def get_gen_func(self, D, style):
+        from sage.all import loads
+        conn = self._connection()
+        rows = conn.execute(
+            "SELECT certificate, gen_func FROM gen_funcs WHERE size=? AND "
+            "rank=? AND atoms=? AND whitney=? AND style=?", 
+            _invariants(D) + tuple([style])
+        ).fetchall()
+        if len(rows) == 0:
+            return None
+        cert = _certificate(D)
+        for c, F in rows:
+            if c == cert:
+                return loads(F)
+        return None
+
+    def save_gen_func(self, D, style, F):
+        from sage.all import dumps
+        row = tuple([_certificate(D), style]) + _invariants(D) + tuple([dumps(F)])
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO gen_funcs VALUES (?, ?, ?, ?, ?, ?, ?)", 
+                row
+            )
 
 
 class IADatabase():
 
-    def __init__(self):
+    def __init__(self, file=None):
         self.poset_list = []
         self.gen_func_list = []
+        # Maps the invariants of a lattice to the indices of the stored
+        # lattices with these invariants.
+        self.index = {}
+        # The certificates of the stored lattices, computed when first needed.
+        self._certificates = []
+        self.hits = 0
+        self.misses = 0
+        self.disk = None
+        if file != None:
+            self.connect(file)
 
     def __repr__(self):
+        if self.disk != None:
+            return "A database indexed by %s posets and stored in %s" % (len(self.poset_list), self.disk.file)
         return "A database indexed by %s posets" % (len(self.poset_list))
 
-    def has_poset(self, P):
-        L = self.poset_list
-        return _check(L, P, 0)
-
-    def get_gen_func(self, P, style):
-        isit, k = self.has_poset(P)
-        if not isit:
-            return None
-        return self.gen_func_list[k][style]
+    def connect(self, file):
+        r"""
+        Store all generating functions in the SQLite file ``file``, and look
+        up the ones computed by earlier sessions there.
+        """
+        self.disk = _DiskDatabase(file)
+
+    def stats(self):
+        r"""
+        Return the number of hits and misses of the lookups so far.
+        """
+        return {'hits' : self.hits, 'misses' : self.misses}
+
+    def _stored_certificate(self, k):
+        if self._certificates[k] == None:
+            self._certificates[k] = _certificate(self.poset_list[k])
+        return self._certificates[k]
+
+    # Only lattices with the same invariants are compared, by their
+    # certificates.
+    def has_poset(self, D, key=None):
+        if key == None:
+            key = _index_key(D)
+        cert = None
+        for k in self.index.get(key, []):
+            if cert == None:
+                cert = _certificate(D)
+            if self._stored_certificate(k) == cert:
+                return True, k
+        return False, None
 
-    def save_gen_func(self, P, style, F):
-        assert P.rank() > 2
+    def get_gen_func(self, D, style):
+        key = _index_key(D)
+        isit, k = self.has_poset(D, key=key)
+        if isit and self.gen_func_list[k][style] != None:
+            self.hits += 1
+            return self.gen_func_list[k][style]
+        if self.disk != None:
+            F = self.disk.get_gen_func(D, style)
+            if F != None:
+                self.hits += 1
+                self._save_in_memory(D, style, F, key=key)
+                return F
+        self.misses += 1
+        return None
+
+    def save_gen_func(self, D, style, F):
+        assert D.rank() > 2
         assert style in ['Igusa', 'skele']
-        isit, k = self.has_poset(P)
+        self._save_in_memory(D, style, F)
+        if self.disk != None:
+            self.disk.save_gen_func(D, style, F)
+
+    def _save_in_memory(self, D, style, F, key=None):
+        if key == None:
+            key = _index_key(D)
+        isit, k = self.has_poset(D, key=key)
         if not isit:
-            # New poset, so we save it.
+            # New lattice, so we save it.
             gen_dict = {
                 'Igusa' : None,
                 'skele' : None
             }
             gen_dict[style] = F
-            self.poset_list += [P]
-            self.gen_func_list += [gen_dict]
+            self.index.setdefault(key, []).append(len(self.poset_list))
+            self.poset_list.append(D)
+            self._certificates.append(None)
+            self.gen_func_list.append(gen_dict)
         else:
             if self.gen_func_list[k][style] == None:
-                GFL = self.gen_func_list
-                GFL[k][style] = F
-                self.gen_func_list = GFL
-
+                self.gen_func_list[k][style] = F
 
 def _initialize_main_DB():
     from sage.all import DiGraph, Poset, var
+    from .LatticeFlats import LatticeOfFlats
     import hypigu.src.init_data as init_data
+    compact = lambda rels: LatticeOfFlats(poset=Poset(DiGraph(rels)))._data
     q = var('q')
     t = var('t')
     Y = var('Y')
@@ -65,33 +192,35 @@ def _initialize_main_DB():
     DB = IADatabase()
 
     # A3 arrangement 
-    A3 = Poset(DiGraph(init_data.A3_rels))
+    A3 = compact(init_data.A3_rels)
     A3_Igusa = q**-6*(1-q**-1)*(q**4*(6-5*q+q**2)-4*q**4*(2-q)*t-q**2*(3-7*q+2*q**2)*t**2+q**2*(2-7*q+3*q**2)*t**3-4*q*(1-2*q)*t**4-(1-5*q+6*q**2)*t**5)/((1-q**-1*t)**2*(1-q**-2*t**3)*(1-q**-3*t**6))
     A3_skele = ((1 + 6*Y + 11*Y**2 + 6*Y**3) + (11 + 37*Y + 37*Y**2 + 11*Y**3)*T + (6 + 11*Y + 6*Y**2 + Y**3)*T**2)/((1 - T)**3)
     DB.save_gen_func(A3, 'Igusa', A3_Igusa)
     DB.save_gen_func(A3, 'skele', A3_skele)
 
     # A4 arrangement 
-    A4 = Poset(DiGraph(init_data.A4_rels))
+    A4 = compact(init_data.A4_rels)
     A4_skele = ((1 + 10*Y + 35*Y**2 + 50*Y**3 + 24*Y**4) + (47 + 260*Y + 505*Y**2 + 400*Y**3 + 108*Y**4)*T + (108 + 400*Y + 505*Y**2 + 260*Y**3 + 47*Y**4)*T**2 + (24 + 50*Y + 35*Y**2 + 10*Y**3 + Y**4)*T**3)/((1 - T)**4)
     A4_Igusa = init_data.A4_Igusa_n(q, t) / init_data.A4_Igusa_d(q, t)
     DB.save_gen_func(A4, 'skele', A4_skele)
     DB.save_gen_func(A4, 'Igusa', A4_Igusa)
     
     # A5 arrangement
-    A5 = Poset(DiGraph(init_data.A5_rels))
+    A5 = compact(init_data.A5_rels)
     A5_skele = (Y**5*T**4 + 197*Y**5*T**3 + 15*Y**4*T**4 + 1268*Y**5*T**2 + 1546*Y**4*T**3 + 85*Y**3*T**4 + 1114*Y**5*T + 7172*Y**4*T**2 + 4670*Y**3*T**3 + 225*Y**2*T**4 + 120*Y**5 + 4493*Y**4*T + 15320*Y**3*T**2 + 6700*Y**2*T**3 + 274*Y*T**4 + 274*Y**4 + 6700*Y**3*T + 15320*Y**2*T**2 + 4493*Y*T**3 + 120*T**4 + 225*Y**3 + 4670*Y**2*T + 7172*Y*T**2 + 1114*T**3 + 85*Y**2 + 1546*Y*T + 1268*T**2 + 15*Y + 197*T + 1)/((1 - T)**5)
     A5_Igusa = init_data.A5_Igusa_n(q, t) / init_data.A5_Igusa_d(q, t)
     DB.save_gen_func(A5, 'skele', A5_skele)
     DB.save_gen_func(A5, 'Igusa', A5_Igusa)
 
     # B3 arrangement
-    B3 = Poset(DiGraph(init_data.B3_rels))
+    B3 = compact(init_data.B3_rels)
     B3_skele = (Y**3*T**2 + 20*Y**3*T + 9*Y**2*T**2 + 15*Y**3 + 76*Y**2*T + 23*Y*T**2 + 23*Y**2 + 76*Y*T + 15*T**2 + 9*Y + 20*T + 1)/((1 - T)**3)
     B3_Igusa = init_data.B3_Igusa_n(q, t) / init_data.B3_Igusa_d(q, t)
     DB.save_gen_func(B3, 'skele', B3_skele)
     DB.save_gen_func(B3, 'Igusa', B3_Igusa)
 
+    if _db_file != None:
+        DB.connect(_db_file)
     return DB
 
 global internal_database
@@ -7,29 +7,92 @@
 from .Database import internal_database as _data
 from .Globals import __PRINT as _print
 from .Globals import __TIME as _time
+from .CompactLattice import _popcount
+from .Modular import _Igusa_zeta_function_mod, _comb_skele_mod
+from .Modular import _Igusa_numerator_mod, _comb_skele_numerator_mod
+from .GeneratingFunction import GeneratingFunction
 from functools import reduce as _reduce
 
-# A function to return a poincare function.
+# Returns the field in which the given engine does its arithmetic. The
+# 'symbolic' engine works in the Symbolic Ring, which we encode by None, and
+# the 'rational', 'dp', and 'modular' engines work in the field of rational
+# functions in the given variable names.
+def _engine_ring(engine, names):
+    if engine == 'symbolic':
+        return None
+    if engine in ['rational', 'dp', 'modular']:
+        from sage.all import PolynomialRing, QQ
+        return PolynomialRing(QQ, list(names)).fraction_field()
+    raise ValueError("Unknown engine: {0}".format(engine))
+
+# Returns the variable with the given name in the ring of the engine.
+def _gen(ring, name):
+    if ring is None:
+        from sage.all import var
+        return var(name)
+    return ring.gen(ring.variable_names().index(name))
+
+# Converts a symbolic rational function F into an element of ring.
+def _from_SR(F, ring):
+    from sage.all import SR
+    if ring is None:
+        return F
+    R = ring.ring()
+    N, D = SR(F).numerator_denominator()
+    return ring(N.polynomial(ring=R))/ring(D.polynomial(ring=R))
+
+def _to_SR(F):
+    from sage.all import SR
+    return SR(F)
+
+# Sums the terms. Over the Symbolic Ring, we keep the original order of the
+# summation. Otherwise we sum in pairs, so that the summands stay small.
+def _sum(terms, ring, start=0):
+    if ring is None:
+        return _reduce(lambda x, y: x + y, terms, start)
+    terms = list(terms)
+    while len(terms) > 1:
+        pairs = zip(terms[::2], terms[1::2])
+        odd = terms[-1:] if len(terms) % 2 == 1 else []
+        terms = [x + y for x, y in pairs] + odd
+    if len(terms) == 0:
+        return start
+    return start + terms[0]
+
+# A function to return a poincare function. The Poincare polynomials of the
+# restrictions are those of the upper intervals of L, which are all read off
+# from the Mobius function of L at once.
 def _Poincare_polynomial(L, sub=None):
     from sage.all import var 
     if sub == None:
         sub = var('Y')
+    D = L._data
+    U, _ = D.poincare_arrays()
     def poincare(x):
-        pi = L.restriction(x).Poincare_polynomial()
-        try:
-            return pi.subs({pi.variables()[0] : sub})
-        except AttributeError: # In case pi is a constant.
-            return pi
+        row = U[D.index[x]]
+        return sum(int(row[k])*sub**k for k in range(len(row)))
     return poincare
 
-# The complete solutions for small central arrangements of rank <= 2.
-def _small_central(A, style, numerator=False):
-    from sage.all import var
+# Returns the function x -> pi_x(Y)/(1 + Y)^C evaluated at Y = -1, where pi_x
+# is the Poincare polynomial of the restriction to x. 
+def _Poincare_circ(L, C, ring=None):
+    from sage.all import PolynomialRing, QQ
+    if ring is None:
+        poincare = _Poincare_polynomial(L)
+        Y = poincare(L._data.elements[0]).variables()[0]
+        return lambda x: (poincare(x)/(1 + Y)**C).factor().simplify().subs({Y: -1})
+    Y = PolynomialRing(QQ, 'Y').gen()
+    poincare = _Poincare_polynomial(L, sub=Y)
+    return lambda x: ring((poincare(x) // (1 + Y)**C)(-1))
 
-    p = var('q')
-    t = var('t')
-    Y = var('Y')
-    T = var('T')
+# The complete solutions for small central arrangements of rank <= 2.
+def _small_central(A, style, numerator=False, ring=None):
+    if style == 'Igusa':
+        p = _gen(ring, 'q')
+        t = _gen(ring, 't')
+    else:
+        Y = _gen(ring, 'Y')
+        T = _gen(ring, 'T')
     if A.rank() == 1:
         if style == 'Igusa':
             return (1 - p**-1)/(1 - p**-1*t)
@@ -48,229 +111,465 @@ def _small_central(A, style, numerator=False):
         else:
             return (1 + m*Y + (m-1)*Y**2 + (m-1 + m*Y + Y**2)*T)/((1 - T)**2)
 
+# Returns the positions of the proper part of the compact lattice D: all
+# elements but the bottom and, if there is one, the top.
+def _proper_part(D):
+    top = D.top()
+    return [i for i in range(1, len(D)) if i != top]
+
+# The variable names used by _universal for the lattice of flats L.
+def _universal_names(L, anayltic=False, atom=False):
+    D = L._data
+    if not anayltic:
+        return ['Y'] + ["T" + str(x) for x in D.elements]
+    if atom:
+        return ['q'] + ["t" + str(x) for x in L.atoms()]
+    return ['q'] + ["t" + str(x) for x in D.elements[1:]]
+
 # The direct version of the universal generating function computation.
-def _universal(L, anayltic=False, atom=False):
-    from sage.all import var
-    from .LatticeFlats import _subposet
+def _universal(L, anayltic=False, atom=False, ring=None):
+    D = L._data
 
     # Set up the potential substitutions for T -- as defined in Maglione--Voll.
     if anayltic:
-        q = var('q')
+        q = _gen(ring, 'q')
         Y = -q**(-1)
-        P = L.poset
-        t_name = lambda x: var("t" + str(x))
+        t_name = lambda x: _gen(ring, "t" + str(x))
         if atom:
-            atoms = P.upper_covers(P.bottom())
             def T_data(x):
-                under_poset = _subposet(P, x, lambda z: P.lower_covers(z))
-                elts = filter(lambda y: y in under_poset, atoms)
+                i = D.index[x]
+                elts = [D.elements[j] for j in D.atoms_below(i)]
                 ts = map(t_name, elts)
-                return _reduce(lambda x, y: x*y, ts, q**(-P.rank(x)))
+                return _reduce(lambda x, y: x*y, ts, q**(-D.ranks[i]))
         else:
             def T_data(x):
-                under_poset = _subposet(P, x, lambda z: P.lower_covers(z))
-                elts = list(under_poset._elements)
-                elts.remove(P.bottom())
+                i = D.index[x]
+                elts = [D.elements[j] for j in D.down_set(i) if j != 0]
                 ts = map(t_name, elts)
-                return _reduce(lambda x, y: x*y, ts, q**(-P.rank(x)))
+                return _reduce(lambda x, y: x*y, ts, q**(-D.ranks[i]))
     else: 
-        T_data = lambda x: var("T" + str(x))
-        Y = var('Y')
+        T_data = lambda x: _gen(ring, "T" + str(x))
+        Y = _gen(ring, 'Y')
 
-    T = {x : T_data(x) for x in L.poset._elements}
+    T = {x : T_data(x) for x in D.elements}
     
     # Base cases for recursion.
-    if L.poset.has_top() and L.poset.rank() == 2:
-        elts = L.proper_part_poset()._elements
+    if D.has_top() and D.rank() == 2:
+        elts = [D.elements[i] for i in _proper_part(D)]
         merge = lambda x, y: x + (1 + Y)**2*T[y]/(1 - T[y])
-        one = L.poset.top()
+        one = D.elements[D.top()]
         return _reduce(merge, elts, (1 + Y)*(1 + (len(elts) - 1)*Y))/(1-T[one])
-    if L.poset.rank == 1:
-        elts = list(L.poset._elements).remove(L.poset.bottom())
+    if D.rank() == 1:
+        elts = D.elements[1:]
         merge = lambda x, y: x + (1 + Y)*T[y]/(1 - T[y])
         return _reduce(merge, elts, 1 + len(elts)*Y)
     
-    P = L.proper_part_poset()
     poincare = _Poincare_polynomial(L, sub=Y)
-    recurse = lambda M: _universal(M, anayltic=anayltic, atom=atom)
+    recurse = lambda M: _universal(M, anayltic=anayltic, atom=atom, ring=ring)
     num_dat = lambda x: poincare(x)*T[x]*recurse(L.subarrangement(x))
-    factors = map(num_dat, P._elements)
-    HP = _reduce(lambda x, y: x + y, factors, poincare(L.poset.bottom()))
-    if L.poset.has_top():
-        HP = HP/(1 - T[L.poset.top()])
+    factors = map(num_dat, [D.elements[i] for i in _proper_part(D)])
+    HP = _sum(factors, ring, start=poincare(D.elements[0]))
+    if D.has_top():
+        HP = HP/(1 - T[D.elements[D.top()]])
     return HP
 
-def _Igusa_zeta_function(L, DB=True, verbose=_print):
-    from sage.all import var
+def _Igusa_zeta_function(L, DB=True, verbose=_print, ring=None):
     from .Constructors import CoxeterArrangement
     from .Braid import BraidArrangementIgusa
     from .LatticeFlats import LatticeOfFlats, _Coxeter_poset_data
+    from .Database import _certificate
 
-    P = L.poset
-    q = var('q')
-    t = var('t')
+    D = L._data
+    q = _gen(ring, 'q')
+    t = _gen(ring, 't')
 
     # Base cases for recursion.
-    if P.has_top() and P.rank() == 2:
-        m = len(P) - 2
+    if D.has_top() and D.rank() == 2:
+        m = len(D) - 2
         return (1 - q**-1)*(1 - (m-1)*q**-1 + m*(1 - q**-1)*q**-1*t/(1 - q**-1*t))/(1 - q**-2*t**m)
-    if P.rank() == 1:
-        m = len(P) - 1
+    if D.rank() == 1:
+        m = len(D) - 1
         return 1 - m*q**-1 + m*(1 - q**-1)*q**-1*t/(1 - q**-1*t)
 
     if DB:
-        zeta = _data.get_gen_func(P, 'Igusa')
+        zeta = _data.get_gen_func(D, 'Igusa')
         if zeta != None:
-            return zeta
+            return _from_SR(zeta, ring)
     # We check to see if we have a type A braid arrangement. 
     # We can compute these *extremely* quickly.
-    if _Coxeter_poset_data()['A']['hyperplanes'](P.rank()) == len(L.atoms()):
-        if _Coxeter_poset_data()['A']['poset'](P.rank()) == len(P):
-            B = CoxeterArrangement("A" + str(P.rank()))
-            if P.is_isomorphic(LatticeOfFlats(B).poset):
-                return BraidArrangementIgusa(P.rank())
+    if _Coxeter_poset_data()['A']['hyperplanes'](D.rank()) == len(D.atoms()):
+        if _Coxeter_poset_data()['A']['poset'](D.rank()) == len(D):
+            B = CoxeterArrangement("A" + str(D.rank()))
+            if _certificate(D) == _certificate(LatticeOfFlats(B)._data):
+                return _from_SR(BraidArrangementIgusa(D.rank()), ring)
 
     poincare = _Poincare_polynomial(L, sub=-q**(-1))
-    t_factor = lambda X: t**len(L.flat_labels[X])
-    x_factor = lambda x: poincare(x)*t_factor(x)*q**(-P.rank(x))
+    t_factor = lambda i: t**len(D.atoms_below(i))
+    x_factor = lambda x: poincare(x)*t_factor(D.index[x])*q**(-D.ranks[D.index[x]])
     eq_elt_data = L._combinatorial_eq_elts()
     factors = map(lambda x: x[1]*x_factor(x[0]), eq_elt_data)
-    integrals = map(lambda x: _Igusa_zeta_function(x[2], DB=DB), eq_elt_data)
-    pi = poincare(P.bottom())
-    zeta = _reduce(lambda x, y: x + y[0]*y[1], zip(factors, integrals), 0) + pi
-    if P.has_top():
-        zeta = zeta/(1 - q**(-P.rank())*t**len(L.atoms()))
-    if DB and P.rank() > 2: 
-        _data.save_gen_func(P, 'Igusa', zeta)
+    integrals = map(lambda x: _Igusa_zeta_function(x[2], DB=DB, ring=ring), eq_elt_data)
+    pi = poincare(D.elements[0])
+    zeta = _sum(map(lambda y: y[0]*y[1], zip(factors, integrals)), ring) + pi
+    if D.has_top():
+        zeta = zeta/(1 - q**(-D.rank())*t**len(D.atoms()))
+    if DB and D.rank() > 2: 
+        _data.save_gen_func(D, 'Igusa', _to_SR(zeta))
     return zeta
 
 
-def _top_zeta_function_uni(L, DB=True, verbose=_print):
-    from sage.all import var
-
-    P = L.poset
-    s = var('s')
-    C = 1*L.poset.has_top()
+def _top_zeta_function_uni(L, DB=True, verbose=_print, ring=None):
+    D = L._data
+    s = _gen(ring, 's')
+    C = 1*D.has_top()
 
     # Base cases for recursion.
-    if P.has_top() and P.rank() == 2:
-        m = len(P) - 2
+    if D.has_top() and D.rank() == 2:
+        m = len(D) - 2
         return (2 + (2 - m)*s)/((2 + m*s)*(1 + s))
-    if P.rank() == 1:
-        m = len(P) - 1
+    if D.rank() == 1:
+        m = len(D) - 1
         return (1 + (1 - m)*s)/(1 + s)
 
-    poincare = _Poincare_polynomial(L)
-    Y = poincare(P.bottom()).variables()[0]
-    pi_circ = lambda x: (poincare(x)/(1 + Y)**C).factor().simplify().subs({Y: -1})
+    pi_circ = _Poincare_circ(L, C, ring=ring)
     eq_elt_data = L._combinatorial_eq_elts()
     factors = map(lambda x: x[1]*pi_circ(x[0]), eq_elt_data)
-    integrals = map(lambda x: _top_zeta_function_uni(x[2], DB=DB), eq_elt_data)
-    pi = pi_circ(P.bottom())
-    zeta = _reduce(lambda x, y: x + y[0]*y[1], zip(factors, integrals), 0) + pi
+    integrals = map(lambda x: _top_zeta_function_uni(x[2], DB=DB, ring=ring), eq_elt_data)
+    pi = pi_circ(D.elements[0])
+    zeta = _sum(map(lambda y: y[0]*y[1], zip(factors, integrals)), ring) + pi
     if C == 1:
-        zeta = zeta/(P.rank() + len(L.atoms())*s)
+        zeta = zeta/(D.rank() + len(D.atoms())*s)
 
     return zeta
 
 
-def _top_zeta_function_mul(L, DB=True, verbose=_print, atom=False):
-    from sage.all import var
-    from .LatticeFlats import _subposet
+# The variable names used by _top_zeta_function_mul for the lattice of flats L.
+def _top_mul_names(L, atom=False):
+    if atom:
+        return ["s" + str(x) for x in L.atoms()]
+    return ["s" + str(x) for x in L._data.elements[1:]]
 
-    P = L.poset
-    C = 1*L.poset.has_top()
+def _top_zeta_function_mul(L, DB=True, verbose=_print, atom=False, ring=None):
+    D = L._data
+    C = 1*D.has_top()
 
-    s_name = lambda x: var("s" + str(x))
+    s_name = lambda x: _gen(ring, "s" + str(x))
     if atom:
-        if atom:
-            atoms = P.upper_covers(P.bottom())
-            def s_data(x):
-                under_poset = _subposet(P, x, lambda z: P.lower_covers(z))
-                elts = filter(lambda y: y in under_poset, atoms)
-                ts = map(s_name, elts)
-                return _reduce(lambda x, y: x + y, ts, 0)
+        def s_data(x):
+            elts = [D.elements[j] for j in D.atoms_below(D.index[x])]
+            ts = map(s_name, elts)
+            return _reduce(lambda x, y: x + y, ts, 0)
     else:
         def s_data(x):
-            under_poset = _subposet(P, x, lambda z: P.lower_covers(z))
-            elts = list(under_poset._elements)
-            elts.remove(P.bottom())
+            elts = [D.elements[j] for j in D.down_set(D.index[x]) if j != 0]
             ts = map(s_name, elts)
             return _reduce(lambda x, y: x + y, ts, 0)
 
-    S = {x : s_data(x) for x in P._elements}
+    S = {x : s_data(x) for x in D.elements}
 
     # Base cases for recursion.
     add_em = lambda x, y: x + y
-    if P.has_top() and P.rank() == 2:
-        atms = P.upper_covers(P.bottom())
+    if D.has_top() and D.rank() == 2:
+        atms = L.atoms()
         m = len(atms)
         elt_dat = lambda x: 1/(1 + S[x])
-        return _reduce(add_em, map(elt_dat, atms), 2 - m)/(2 + S[P.top()])
-    if P.rank() == 1:
-        atms = P.upper_covers(P.bottom())
+        return _reduce(add_em, map(elt_dat, atms), 2 - m)/(2 + S[D.elements[D.top()]])
+    if D.rank() == 1:
+        atms = L.atoms()
         m = len(atms)
         elt_dat = lambda x: 1/(1 + S[x])
         return _reduce(add_em, map(elt_dat, atms), 1 - m)
 
-    poincare = _Poincare_polynomial(L)
-    Y = poincare(P.bottom()).variables()[0]
-    pi_circ = lambda x: (poincare(x)/(1 + Y)**C).factor().simplify().subs({Y: -1})
+    pi_circ = _Poincare_circ(L, C, ring=ring)
     x_factor = lambda x: pi_circ(x)
-    prop_elts = L.proper_part_poset()._elements
+    prop_elts = [D.elements[i] for i in _proper_part(D)]
     factors = map(lambda x: x_factor(x), prop_elts)
-    integrals = map(lambda x: _top_zeta_function_mul(L.subarrangement(x), DB=DB, atom=atom), prop_elts)
-    pi = pi_circ(P.bottom())
-    zeta = _reduce(lambda x, y: x + y[0]*y[1], zip(factors, integrals), 0) + pi
-    if P.has_top():
-        zeta = zeta/(P.rank() + S[P.top()])
+    integrals = map(lambda x: _top_zeta_function_mul(L.subarrangement(x), DB=DB, atom=atom, ring=ring), prop_elts)
+    pi = pi_circ(D.elements[0])
+    zeta = _sum(map(lambda y: y[0]*y[1], zip(factors, integrals)), ring) + pi
+    if D.has_top():
+        zeta = zeta/(D.rank() + S[D.elements[D.top()]])
 
     return zeta
 
 
-def _comb_skele(L, DB=True, verbose=_print):
-    from sage.all import var
-    P = L.poset
-    Y = var('Y')
-    T = var('T')
+def _comb_skele(L, DB=True, verbose=_print, ring=None):
+    D = L._data
+    Y = _gen(ring, 'Y')
+    T = _gen(ring, 'T')
 
-    if P.has_top():
-        if P.rank() == 1:
+    if D.has_top():
+        if D.rank() == 1:
             return (1 + Y)/(1 - T)
-        if P.rank() == 2:
-            m = len(P) - 2
+        if D.rank() == 2:
+            m = len(D) - 2
             return (1 + m*Y + (m - 1)*Y**2 + (m - 1 + m*Y + Y**2)*T)/(1 - T)**2
     if DB:
         if verbose:
             print(_time() + "Checking database.")
-        zeta = _data.get_gen_func(P, 'skele')
+        zeta = _data.get_gen_func(D, 'skele')
         if zeta != None:
-            return zeta
+            return _from_SR(zeta, ring)
         if verbose:
             print("\tDone.")
 
-    poincare = _Poincare_polynomial(L)
+    poincare = _Poincare_polynomial(L, sub=Y)
     if verbose: 
         print(_time() + "Gleaning structure from poset.")
     eq_elt_data = L._combinatorial_eq_elts()
     if verbose:
         print("\tDone.")
-        print(_time() + "Lattice points: {0},  Relevant points: {1}".format(len(P), len(eq_elt_data)))
+        print(_time() + "Lattice points: {0},  Relevant points: {1}".format(len(D), len(eq_elt_data)))
     factors = map(lambda x: x[1]*T*poincare(x[0]), eq_elt_data)
     if verbose:
         print(_time() + "Recursing...")
-    integrals = map(lambda x: _comb_skele(x[2], DB=DB), eq_elt_data)
+    integrals = map(lambda x: _comb_skele(x[2], DB=DB, ring=ring), eq_elt_data)
     if verbose:
         print(_time() + "Putting everything together...")
-    pi = poincare(P.bottom())
-    zeta = _reduce(lambda x, y: x + y[0]*y[1], zip(factors, integrals), 0) + pi
-    if P.has_top():
+    pi = poincare(D.elements[0])
+    zeta = _sum(map(lambda y: y[0]*y[1], zip(factors, integrals)), ring) + pi
+    if D.has_top():
         zeta = zeta/(1 - T)
-    if DB and P.rank() > 2: 
-        _data.save_gen_func(P, 'skele', zeta)
+    if DB and D.rank() > 2: 
+        _data.save_gen_func(D, 'skele', _to_SR(zeta))
         
     return zeta
 
+# The bottom-up version of the recursions for Igusa's zeta function and the
+# coarse flag Hilbert--Poincare series over the compact lattice D. The flats
+# are visited once, in order of rank. When the generating function Z_y of the
+# interval [0, y] is known, its contribution is pushed to all flats above y, so
+# no lattices of intervals are built. Here ev evaluates a Poincare polynomial
+# given by its coefficients, and weight(y) is the factor of Z_y in the
+# numerator of Z_x. The denominator of Z_x is the product of factor(key(z))
+# over the distinct keys of the flats 0 < z <= x, and it is known before the
+# recursion starts, so only the numerators are computed. Returns the numerator
+# and the set of keys of the denominator.
+def _dp_numerators(D, ev, weight, key, factor, verbose=_print):
+    top = D.top()
+    keys = [frozenset()]
+    for x in range(1, len(D)):
+        keys.append(_reduce(
+            lambda K, c: K.union(keys[c]), D.lower_covers(x), frozenset([key(x)])
+        ))
+    all_keys = keys[top] if top != None else _reduce(
+        lambda K, L: K.union(L), keys, frozenset()
+    )
+    # The products of the factors that are missing from the denominators.
+    prods = {}
+    def missing(K):
+        if not K in prods:
+            prods[K] = _reduce(lambda a, b: a*factor(b), K, 1)
+        return prods[K]
+
+    num = [0]*len(D)
+    total = 0
+    for y in range(len(D)):
+        if verbose and y % 1000 == 0:
+            print("{0}Flats done: {1} of {2}".format(_time(), y, len(D)))
+        mu, row = D.poincare_row(y)
+        if y == 0:
+            w = 1
+        else:
+            if y == top:
+                return num[y], all_keys
+            w = weight(y)*num[y]
+        for x, coeffs in row.items():
+            if x != y:
+                K = keys[x].difference(keys[y]).difference([key(x)])
+                num[x] += ev(coeffs)*w*missing(K)
+        # Without a top element, we need the upper set of y, not an interval.
+        if top is None:
+            coeffs = [0]*(D.rank() - D.ranks[y] + 1)
+            for z, m in mu.items():
+                r = D.ranks[z] - D.ranks[y]
+                coeffs[r] += (-1)**r*m
+            total += ev(coeffs)*w*missing(all_keys.difference(keys[y]))
+        num[y] = None
+    return total, all_keys
+
+# Returns a function evaluating coefficient lists of polynomials at Y.
+def _evaluator(Y, deg):
+    powers = [Y**k for k in range(deg + 1)]
+    return lambda c: sum(c[k]*powers[k] for k in range(len(c)))
+
+# Returns the numerator of Igusa's zeta function of L, as a polynomial in
+# u = q^-1 and t with integer coefficients, and the list of pairs (a, b) such
+# that the denominator is the product of the factors 1 - q^-a*t^b.
+def _Igusa_numerator_dp(L, verbose=_print):
+    from sage.all import PolynomialRing, ZZ
+    D = L._data
+    u, t = PolynomialRing(ZZ, ['u', 't']).gens()
+
+    size = lambda y: _popcount(D.masks[y])
+    weight = lambda y: t**size(y)*u**D.ranks[y]
+    key = lambda y: (D.ranks[y], size(y))
+    factor = lambda k: 1 - u**k[0]*t**k[1]
+    ev = _evaluator(-u, D.rank())
+    N, keys = _dp_numerators(D, ev, weight, key, factor, verbose=verbose)
+    return N, sorted(keys)
+
+# Returns the numerator of the coarse flag Hilbert--Poincare series of L, as a
+# polynomial in Y and T with integer coefficients, and the list of pairs (0, 1)
+# of the factors 1 - T of the denominator.
+def _comb_skele_numerator_dp(L, verbose=_print):
+    from sage.all import PolynomialRing, ZZ
+    D = L._data
+    Y, T = PolynomialRing(ZZ, ['Y', 'T']).gens()
+
+    ev = _evaluator(Y, D.rank())
+    key = lambda y: D.ranks[y]
+    N, keys = _dp_numerators(D, ev, lambda y: T, key, lambda k: 1 - T, verbose=verbose)
+    return N, [(0, 1)]*len(keys)
+
+# Returns N/prod(1 - X^a*Z^b) in the ring of the engine, where N is a
+# polynomial in two variables and pairs is the list of pairs (a, b).
+def _assemble(N, pairs, X, Z):
+    den = _reduce(lambda x, y: x*y, [1 - X**a*Z**b for a, b in pairs], 1)
+    num = sum(c*X**i*Z**j for (i, j), c in N.dict().items())
+    return num/den
+
+def _Igusa_zeta_function_dp(L, DB=True, verbose=_print, ring=None):
+    D = L._data
+    q = _gen(ring, 'q')
+    t = _gen(ring, 't')
+
+    if DB and D.rank() > 2:
+        zeta = _data.get_gen_func(L._data, 'Igusa')
+        if zeta != None:
+            return _from_SR(zeta, ring)
+
+    N, pairs = _Igusa_numerator_dp(L, verbose=verbose)
+    zeta = _assemble(N, pairs, q**-1, t)
+    if DB and D.rank() > 2:
+        _data.save_gen_func(L._data, 'Igusa', _to_SR(zeta))
+    return zeta
+
+def _comb_skele_dp(L, DB=True, verbose=_print, ring=None):
+    D = L._data
+    Y = _gen(ring, 'Y')
+    T = _gen(ring, 'T')
+
+    if DB and D.rank() > 2:
+        zeta = _data.get_gen_func(L._data, 'skele')
+        if zeta != None:
+            return _from_SR(zeta, ring)
+
+    N, pairs = _comb_skele_numerator_dp(L, verbose=verbose)
+    zeta = _assemble(N, pairs, Y, T)
+    if DB and D.rank() > 2:
+        _data.save_gen_func(L._data, 'skele', _to_SR(zeta))
+    return zeta
+
+# Returns the columns of the given points as NumPy arrays over base_ring. Over
+# RDF these are float64 arrays, and otherwise arrays of elements of base_ring.
+def _point_arrays(points, base_ring=None):
+    import numpy
+    from sage.all import QQ, RDF
+    if base_ring == None:
+        base_ring = QQ
+    as_tuple = lambda p: tuple(p) if numpy.ndim(p) > 0 else tuple([p])
+    cols = list(zip(*map(as_tuple, points)))
+    if base_ring == RDF:
+        return [numpy.array(list(map(float, c)), dtype=numpy.float64) for c in cols]
+    return [numpy.array(list(map(base_ring, c)), dtype=object) for c in cols]
+
+# Evaluates the polynomial f, with integer coefficients, at the array X.
+def _poly_values(f, X):
+    return sum(int(c)*X**k for k, c in enumerate(f.list()))
+
+# Returns a key for the isomorphism class of the lattice of flats L.
+def _lattice_key(L):
+    D = L._data
+    return D.certificate(list(range(len(D))))
+
+# The values of Igusa's zeta function of L at the arrays of points q and t.
+# This follows _Igusa_zeta_function, but all arithmetic is done with the
+# arrays, and the values of isomorphic lattices are remembered in memo.
+def _Igusa_zeta_values(L, q, t, memo):
+    from sage.all import PolynomialRing, QQ
+    D = L._data
+    r = D.rank()
+
+    # Base cases for recursion.
+    if D.has_top() and r == 2:
+        m = len(D) - 2
+        return (1 - q**-1)*(1 - (m-1)*q**-1 + m*(1 - q**-1)*q**-1*t/(1 - q**-1*t))/(1 - q**-2*t**m)
+    if r == 1:
+        m = len(D) - 1
+        return 1 - m*q**-1 + m*(1 - q**-1)*q**-1*t/(1 - q**-1*t)
+
+    key = _lattice_key(L)
+    if key in memo:
+        return memo[key]
+    poincare = _Poincare_polynomial(L, sub=PolynomialRing(QQ, 'Y').gen())
+    Y = -q**-1
+    eq_elt_data = L._combinatorial_eq_elts()
+    zeta = _poly_values(poincare(D.elements[0]), Y)
+    for x, count, L_x, _ in eq_elt_data:
+        i = D.index[x]
+        x_factor = _poly_values(poincare(x), Y)*t**_popcount(D.masks[i])*q**(-D.ranks[i])
+        zeta = zeta + count*x_factor*_Igusa_zeta_values(L_x, q, t, memo)
+    if D.has_top():
+        zeta = zeta/(1 - q**(-r)*t**len(D.atoms()))
+    memo[key] = zeta
+    return zeta
+
+# The values of the topological zeta function of L at the array of points s.
+def _top_zeta_values(L, s, memo):
+    from sage.all import QQ
+    D = L._data
+    r = D.rank()
+    C = 1*D.has_top()
+
+    # Base cases for recursion.
+    if D.has_top() and r == 2:
+        m = len(D) - 2
+        return (2 + (2 - m)*s)/((2 + m*s)*(1 + s))
+    if r == 1:
+        m = len(D) - 1
+        return (1 + (1 - m)*s)/(1 + s)
+
+    key = _lattice_key(L)
+    if key in memo:
+        return memo[key]
+    pi_circ = _Poincare_circ(L, C, ring=QQ)
+    eq_elt_data = L._combinatorial_eq_elts()
+    zeta = int(pi_circ(D.elements[0])) + 0*s
+    for x, count, L_x, _ in eq_elt_data:
+        zeta = zeta + count*int(pi_circ(x))*_top_zeta_values(L_x, s, memo)
+    if C == 1:
+        zeta = zeta/(r + len(D.atoms())*s)
+    memo[key] = zeta
+    return zeta
+
+# The values of the coarse flag Hilbert--Poincare series of L at the arrays of
+# points Y and T.
+def _comb_skele_values(L, Y, T, memo):
+    from sage.all import PolynomialRing, QQ
+    D = L._data
+
+    # Base cases for recursion.
+    if D.has_top():
+        if D.rank() == 1:
+            return (1 + Y)/(1 - T)
+        if D.rank() == 2:
+            m = len(D) - 2
+            return (1 + m*Y + (m - 1)*Y**2 + (m - 1 + m*Y + Y**2)*T)/(1 - T)**2
+
+    key = _lattice_key(L)
+    if key in memo:
+        return memo[key]
+    poincare = _Poincare_polynomial(L, sub=PolynomialRing(QQ, 'Y').gen())
+    eq_elt_data = L._combinatorial_eq_elts()
+    zeta = _poly_values(poincare(D.elements[0]), Y) + 0*T
+    for x, count, L_x, _ in eq_elt_data:
+        zeta = zeta + count*T*_poly_values(poincare(x), Y)*_comb_skele_values(L_x, Y, T, memo)
+    if D.has_top():
+        zeta = zeta/(1 - T)
+    memo[key] = zeta
+    return zeta
+
 # Given a polynomial, return a hyperplane arrangement equivalent to the linear
 # factors of f. 
 def _parse_poly(f): 
@@ -313,13 +612,14 @@ def _parse_poly(f):
 
 
 
-def CoarseFlagHPSeries(A=None, lattice_of_flats=None, int_poset=None, matroid=None, numerator=False, verbose=_print):
+def CoarseFlagHPSeries(A=None, lattice_of_flats=None, int_poset=None, matroid=None, numerator=False, verbose=_print, engine='symbolic', structured=False):
     from .LatticeFlats import LatticeOfFlats
 
+    ring = _engine_ring(engine, ['Y', 'T'])
     if matroid == None: 
         try:
-            if A.is_central() and A.rank() <= 2:
-                return _small_central(A, 'skele', numerator=numerator)
+            if A.is_central() and A.rank() <= 2 and not structured:
+                return _small_central(A, 'skele', numerator=numerator, ring=ring)
         except AttributeError:
             raise TypeError("object is not a hyperplane arrangement.")
     if lattice_of_flats == None:
@@ -334,24 +634,40 @@ def CoarseFlagHPSeries(A=None, lattice_of_flats=None, int_poset=None, matroid=No
 
     if verbose:
         print("{0}Computing coarse flag Hilbert--Poincare series".format(_time()))
-    cfHP = _comb_skele(L)
+
+    # The denominator is known, so only the numerator is computed.
+    if numerator or structured:
+        if engine == 'modular':
+            N, pairs = _comb_skele_numerator_mod(L, verbose=verbose)
+        else:
+            N, pairs = _comb_skele_numerator_dp(L, verbose=verbose)
+        if structured:
+            return GeneratingFunction(N, pairs, 'skele')
+        if ring != None:
+            return ring.ring()(N)
+        return _to_SR(N).factor()
+
+    if engine == 'dp':
+        cfHP = _comb_skele_dp(L, ring=ring, verbose=verbose)
+    elif engine == 'modular':
+        cfHP = _comb_skele_mod(L, ring=ring, verbose=verbose)
+    else:
+        cfHP = _comb_skele(L, ring=ring)
     
-    if numerator:
-        D = cfHP.numerator_denominator()[1]
-        T = D.variables()[0]
-        if D == (T - 1)**(L.poset.rank()): 
-            e = -1
-        if D == (1 - T)**(L.poset.rank()): 
-            e = 1
-        return e*(cfHP*D).factor()
-    else: 
-        return cfHP 
+    return cfHP 
 
 
-def IgusaZetaFunction(X=None, lattice_of_flats=None, int_poset=None, matroid=None, verbose=_print):
+def IgusaZetaFunction(X=None, lattice_of_flats=None, int_poset=None, matroid=None, verbose=_print, engine='symbolic', points=None, base_ring=None, structured=False):
     from .LatticeFlats import LatticeOfFlats
-    from sage.all import var
+    from sage.all import var, QQ
 
+    ring = _engine_ring(engine, ['q', 't'])
+    if engine == 'dp':
+        Igusa = lambda L: _Igusa_zeta_function_dp(L, ring=ring, verbose=verbose)
+    elif engine == 'modular':
+        Igusa = lambda L: _Igusa_zeta_function_mod(L, ring=ring, verbose=verbose)
+    else:
+        Igusa = lambda L: _Igusa_zeta_function(L, ring=ring)
     HPA = True 
     if matroid == None:
         try:
@@ -375,28 +691,55 @@ def IgusaZetaFunction(X=None, lattice_of_flats=None, int_poset=None, matroid=Non
     else:
         L = lattice_of_flats
 
+    if points is not None:
+        if not HPA and list(M) != [1]*len(M):
+            raise NotImplementedError("Evaluation at points requires a reduced polynomial.")
+        if verbose:
+            print("{0}Evaluating Igusa's zeta function at {1} points".format(_time(), len(points)))
+        q, t = _point_arrays(points, base_ring=base_ring)
+        B = QQ if base_ring == None else base_ring
+        return list(map(B, _Igusa_zeta_values(L, q, t, {})))
+
+    # The denominator is known, so only the numerator is computed.
+    if structured:
+        if not HPA and list(M) != [1]*len(M):
+            raise NotImplementedError("Structured output requires a reduced polynomial.")
+        if verbose:
+            print("{0}Computing the numerator of Igusa's zeta function".format(_time()))
+        if engine == 'modular':
+            N, pairs = _Igusa_numerator_mod(L, verbose=verbose)
+        else:
+            N, pairs = _Igusa_numerator_dp(L, verbose=verbose)
+        return GeneratingFunction(N, pairs, 'Igusa')
+
     if not HPA:
         if list(M) == [1]*len(M):
             if verbose:
                 print("{0}Computing Igusa's zeta function".format(_time()))
-            return _Igusa_zeta_function(L)
+            return Igusa(L)
         else:
             if verbose:
                 print("{0}Computing the atom zeta function".format(_time()))
-            Z = _universal(L, anayltic=True, atom=True)
+            names = _universal_names(L, anayltic=True, atom=True)
+            Z = _universal(L, anayltic=True, atom=True, ring=_engine_ring(engine, names))
+            if ring != None:
+                SUB = {'t' + str(k+1) : _gen(ring, 't')**(M[k]) for k in range(len(M))}
+                SUB['q'] = _gen(ring, 'q')
+                return Z(*[SUB[x] for x in names])
             t = var('t')
             SUB = {var('t' + str(k+1)) : t**(M[k]) for k in range(len(M))}
             return Z.subs(SUB)
 
     if verbose:
         print("{0}Computing Igusa's zeta function".format(_time()))
-    return _Igusa_zeta_function(L)
+    return Igusa(L)
 
 
-def TopologicalZetaFunction(X=None, lattice_of_flats=None, int_poset=None, verbose=_print, multivariate=False, atom=False, matroid=None):
+def TopologicalZetaFunction(X=None, lattice_of_flats=None, int_poset=None, verbose=_print, multivariate=False, atom=False, matroid=None, engine='symbolic', points=None, base_ring=None):
     from .LatticeFlats import LatticeOfFlats
-    from sage.all import var
+    from sage.all import var, QQ
 
+    ring = _engine_ring(engine, ['s'])
     HPA = True 
     if matroid == None:
         try:
@@ -423,22 +766,34 @@ def TopologicalZetaFunction(X=None, lattice_of_flats=None, int_poset=None, verbo
     if verbose:
         print("{0}Computing the topological zeta function".format(_time()))
 
+    if points is not None:
+        if multivariate or (not HPA and list(M) != [1]*len(M)):
+            raise NotImplementedError("Evaluation at points requires the univariate zeta function of a reduced polynomial.")
+        s, = _point_arrays(points, base_ring=base_ring)
+        B = QQ if base_ring == None else base_ring
+        return list(map(B, _top_zeta_values(L, s, {})))
+
     if not HPA:
         if list(M) == [1]*len(M):
-            return _top_zeta_function_uni(L)
+            return _top_zeta_function_uni(L, ring=ring)
         else:
-            Z = _top_zeta_function_mul(L, atom=True)
+            names = _top_mul_names(L, atom=True)
+            Z = _top_zeta_function_mul(L, atom=True, ring=_engine_ring(engine, names))
+            if ring != None:
+                SUB = {'s' + str(k+1) : M[k]*_gen(ring, 's') for k in range(len(M))}
+                return Z(*[SUB[x] for x in names])
             s = var('s')
             SUB = {var('s' + str(k+1)) : M[k]*s for k in range(len(M))}
             return Z.subs(SUB)
 
     if not multivariate:
-        return _top_zeta_function_uni(L)
+        return _top_zeta_function_uni(L, ring=ring)
 
-    return _top_zeta_function_mul(L, atom=atom)
+    names = _top_mul_names(L, atom=atom)
+    return _top_zeta_function_mul(L, atom=atom, ring=_engine_ring(engine, names))
 
 
-def AnalyticZetaFunction(A=None, lattice_of_flats=None, int_poset=None, matroid=None, verbose=_print):
+def AnalyticZetaFunction(A=None, lattice_of_flats=None, int_poset=None, matroid=None, verbose=_print, engine='symbolic'):
     from .LatticeFlats import LatticeOfFlats
 
     if lattice_of_flats == None:
@@ -453,10 +808,11 @@ def AnalyticZetaFunction(A=None, lattice_of_flats=None, int_poset=None, matroid=
 
     if verbose:
         print("{0}Computing the analytic zeta function".format(_time()))
-    return _universal(L, anayltic=True)
+    ring = _engine_ring(engine, _universal_names(L, anayltic=True))
+    return _universal(L, anayltic=True, ring=ring)
 
 
-def AtomZetaFunction(A=None, lattice_of_flats=None, int_poset=None, matroid=None, verbose=_print):
+def AtomZetaFunction(A=None, lattice_of_flats=None, int_poset=None, matroid=None, verbose=_print, engine='symbolic'):
     from .LatticeFlats import LatticeOfFlats
 
     if lattice_of_flats == None:
@@ -471,10 +827,11 @@ def AtomZetaFunction(A=None, lattice_of_flats=None, int_poset=None, matroid=None
 
     if verbose:
         print("{0}Computing the atom zeta function".format(_time()))
-    return _universal(L, anayltic=True, atom=True)
+    ring = _engine_ring(engine, _universal_names(L, anayltic=True, atom=True))
+    return _universal(L, anayltic=True, atom=True, ring=ring)
 
 
-def FlagHilbertPoincareSeries(A=None, lattice_of_flats=None, int_poset=None, matroid=None, verbose=_print):
+def FlagHilbertPoincareSeries(A=None, lattice_of_flats=None, int_poset=None, matroid=None, verbose=_print, engine='symbolic'):
     from .LatticeFlats import LatticeOfFlats
 
     if lattice_of_flats == None:
@@ -489,4 +846,5 @@ def FlagHilbertPoincareSeries(A=None, lattice_of_flats=None, int_poset=None, mat
 
     if verbose:
         print("{0}Computing the flag Hilbert--Poincare series".format(_time()))
-    return _universal(L)
+    ring = _engine_ring(engine, _universal_names(L))
+    return _universal(L, ring=ring)
@@ -0,0 +1,199 @@
+#
+#   Copyright 2022 Joshua Maglione
+#
+#   Distributed under MIT License
+#
+
+from functools import reduce as _reduce
+from numbers import Rational as _Rational
+from sage.misc.cachefunc import cached_method
+
+# The variables of the styles of generating functions. The generating function
+# is N(X, Z)/prod(1 - X^a*Z^b), where X and Z are given in terms of the
+# variables: for Igusa's zeta function X = q^-1 and Z = t, and for the coarse
+# flag Hilbert--Poincare series X = Y and Z = T. The last entry is the
+# exponent of the first variable in X.
+_STYLES = {
+    'Igusa' : ('q', 't', -1),
+    'skele' : ('Y', 'T', 1)
+}
+
+def _multiply(N, M):
+    P = {}
+    for (i, j), c in N.items():
+        for (k, l), d in M.items():
+            e = (i + k, j + l)
+            P[e] = P.get(e, 0) + c*d
+    return {e : c for e, c in P.items() if c != 0}
+
+# Python integers and fractions are coerced to QQ, so that for instance q^-1
+# is not evaluated as a float.
+def _exact(x):
+    if isinstance(x, _Rational):
+        from sage.all import QQ
+        return QQ(x)
+    return x
+
+
+class GeneratingFunction():
+    r"""
+    A generating function N(X, Z)/prod(1 - X^a*Z^b) with a known denominator.
+    The numerator is stored sparsely as a dictionary from pairs of exponents
+    (i, j) of X^i*Z^j to integers, and the denominator as the list of pairs
+    (a, b). The style is either 'Igusa' or 'skele'. The conversions to other
+    forms are computed when first asked for.
+    """
+
+    def __init__(self, numerator, factors, style):
+        if not style in _STYLES:
+            raise ValueError("Unknown style: {0}".format(style))
+        if hasattr(numerator, 'dict'):
+            numerator = numerator.dict()
+        self.numerator = {tuple(e) : c for e, c in numerator.items() if c != 0}
+        self.factors = sorted(factors)
+        self.style = style
+
+    def __repr__(self):
+        x, z, e = _STYLES[self.style]
+        X = x if e == 1 else "{0}^-1".format(x)
+        return "A generating function in {0} and {1} with {2} numerator terms and {3} denominator factors".format(X, z, len(self.numerator), len(self.factors))
+
+    def __eq__(self, other):
+        if not isinstance(other, GeneratingFunction):
+            return False
+        if self.style != other.style:
+            return False
+        if self.factors == other.factors:
+            return self.numerator == other.numerator
+        return self.rational_function() == other.rational_function()
+
+    def __hash__(self):
+        return hash(self.style)
+
+    def variable_names(self):
+        x, z, _ = _STYLES[self.style]
+        return (x, z)
+
+    # Returns X and Z in terms of the given variables x and z.
+    def _XZ(self, x, z):
+        e = _STYLES[self.style][2]
+        return x**e, z
+
+    @cached_method
+    def numerator_polynomial(self):
+        r"""
+        Return the numerator as a polynomial in X and Z with integer
+        coefficients, where X = q^-1 for Igusa's zeta function.
+        """
+        from sage.all import PolynomialRing, ZZ
+        x, z, e = _STYLES[self.style]
+        X = x if e == 1 else "u"
+        return PolynomialRing(ZZ, [X, z])(self.numerator)
+
+    @cached_method
+    def rational_function(self):
+        r"""
+        Return the generating function as an element of the field of rational
+        functions over the rational numbers.
+        """
+        from sage.all import PolynomialRing, QQ
+        K = PolynomialRing(QQ, list(self.variable_names())).fraction_field()
+        X, Z = self._XZ(*K.gens())
+        return self._assemble(X, Z)
+
+    @cached_method
+    def symbolic(self):
+        r"""
+        Return the generating function as a symbolic expression.
+        """
+        from sage.all import var
+        X, Z = self._XZ(*[var(v) for v in self.variable_names()])
+        return self._assemble(X, Z)
+
+    @cached_method
+    def factor(self):
+        r"""
+        Return a symbolic expression with the numerator factored and the
+        denominator given as a product of the factors 1 - X^a*Z^b.
+        """
+        from sage.all import SR, var
+        X, Z = self._XZ(*[var(v) for v in self.variable_names()])
+        N = sum(c*X**i*Z**j for (i, j), c in self.numerator.items())
+        den = [(1 - X**a*Z**b) for a, b in self.factors]
+        return SR(N).factor()/_reduce(lambda x, y: x*y, den, 1)
+
+    def _assemble(self, X, Z):
+        num = sum(c*X**i*Z**j for (i, j), c in self.numerator.items())
+        den = _reduce(lambda x, y: x*y, [1 - X**a*Z**b for a, b in self.factors], 1)
+        return num/den
+
+    @cached_method
+    def _compiled(self):
+        terms = list(self.numerator.items())
+        I = [i for (i, _), _ in terms]
+        J = [j for (_, j), _ in terms]
+        C = [c for _, c in terms]
+        return I, J, C, list(self.factors)
+
+    def __call__(self, x, z):
+        r"""
+        Evaluate the generating function at (x, z), for example (q, t) for
+        Igusa's zeta function. The values can also be NumPy arrays. Python
+        integers and fractions are coerced to the rational numbers.
+        """
+        I, J, C, F = self._compiled()
+        X, Z = self._XZ(_exact(x), _exact(z))
+        num = sum(c*X**i*Z**j for i, j, c in zip(I, J, C))
+        den = _reduce(lambda x, y: x*y, [1 - X**a*Z**b for a, b in F], 1)
+        return num/den
+
+    def __mul__(self, other):
+        r"""
+        Return the product of the two generating functions; for instance,
+        Igusa's zeta function of a direct sum of arrangements is the product
+        of the zeta functions of the summands.
+        """
+        if not isinstance(other, GeneratingFunction):
+            return self.rational_function()*other
+        if self.style != other.style:
+            raise ValueError("Expected generating functions of the same style.")
+        N = _multiply(self.numerator, other.numerator)
+        return GeneratingFunction(N, self.factors + other.factors, self.style)
+
+    def __pow__(self, n):
+        from sage.all import ZZ
+        n = ZZ(n)
+        if n < 0:
+            raise ValueError("Expected a nonnegative exponent.")
+        G = GeneratingFunction({(0, 0) : 1}, [], self.style)
+        for _ in range(n):
+            G = G*self
+        return G
+
+    def monomial_substitution(self, a=1, b=1):
+        r"""
+        Return the generating function with X replaced by X^a and Z replaced
+        by Z^b, for positive integers a and b. For example, b = m replaces t
+        by t^m in Igusa's zeta function.
+        """
+        if a < 1 or b < 1:
+            raise ValueError("Expected positive exponents.")
+        N = {(a*i, b*j) : c for (i, j), c in self.numerator.items()}
+        F = [(a*i, b*j) for i, j in self.factors]
+        return GeneratingFunction(N, F, self.style)
+
+    def subs(self, *args, **kwds):
+        r"""
+        Substitute into the rational function; see ``rational_function``.
+        """
+        return self.rational_function().subs(*args, **kwds)
+
+    def numerator_denominator(self):
+        r"""
+        Return the numerator and the denominator of the rational function in
+        the variables X and Z.
+        """
+        N = self.numerator_polynomial()
+        X, Z = N.parent().gens()
+        den = _reduce(lambda x, y: x*y, [1 - X**a*Z**b for a, b in self.factors], N.parent()(1))
+        return N, den
@@ -6,10 +6,15 @@
 
 from datetime import datetime as _dt
 from os import cpu_count as _cpu_count
+from os import environ as _environ
 
 __PRINT = False
 __SANITY = False
 __NCPUS = max(1, _cpu_count()-1)
+__DATABASE = _environ.get("HYPIGU_DATABASE")
+__MINOR_CACHE_SIZE = 2**14
+__INTERVAL_CACHE_SIZE = 2**12
+__DELETION_RESTRICTION_LIMIT = 2**12
 
 def __TIME(): 
     return "[{0}] ".format(_dt.now().strftime("%b %d %H:%M:%S"))
\ No newline at end of file
@@ -8,11 +8,17 @@ from functools import reduce as _reduce
 from sage.misc.cachefunc import cached_method
 from .Globals import __TIME as _time
 from .Globals import __NCPUS as _N
+from .Globals import __PRINT as _print
+from .Globals import __MINOR_CACHE_SIZE as _minor_size
+from .Globals import __INTERVAL_CACHE_SIZE as _interval_size
+from .Globals import __DELETION_RESTRICTION_LIMIT as _dr_limit
+from collections import OrderedDict as _OrderedDict
 import sage.parallel.decorate as _para
+from .CompactLattice import CompactLattice, _bits
 
 
 def _contract(M, rows):
-    from sage.all import Matrix, identity_matrix
+    from sage.all import Matrix
     K = M.base_ring()
     Q = [M[k] for k in rows] + [M[k] for k in range(M.nrows()) if not k in rows]
     Q = Matrix(K, Q).transpose()
@@ -30,148 +36,243 @@ def _contract(M, rows):
     M_out = Matrix(K, A).transpose()
     return M_out
 
-# BUILD A WAY TO GET THE LABELS FROM THE CONTRACT MATRIX
-def _get_labels(M, x, rows, L):
-    from sage.all import VectorSpace, Set, Matrix
+# Returns the coefficient vector v scaled so that the first nonzero entry of
+# its linear part is 1, as a tuple, so that two vectors define the same
+# hyperplane if and only if their keys agree. Returns None if the linear part
+# of v is zero.
+def _projective_key(v):
+    c = next((a for a in list(v)[1:] if a != 0), None)
+    if c is None:
+        return None
+    return tuple(a/c for a in v)
 
-    # If non-central, then this is true iff not intersecting.
-    not_e1 = lambda v: list(v)[1:] != [0]*(len(v)-1)
+# Groups the rows of the contracted matrix M into the new hyperplanes of the
+# restriction to x. Returns the matrix of new hyperplanes, the masks (in the
+# compact lattice of L) of the hyperplanes in each group, and the positions of
+# the corresponding upper covers of x.
+def _get_labels(M, x, rows, L):
+    from sage.all import Matrix
 
-    # Determine new hyperplanes and group like rows together.
-    V = VectorSpace(M.base_ring(), M.ncols())
-    lines = []
-    labels = []
+    # Group like rows together by their normalized vectors. If non-central,
+    # rows with zero linear part give empty intersections.
+    lines = {}
     for r in range(M.nrows()):
-        v = M[r] 
-        is_new = not_e1(v) 
-        i = 0
-        while i < len(lines) and is_new:
-            if v in V.subspace([lines[i]]):
-                is_new = False 
-                labels[i] = labels[i].union(Set([r]))
-            else:
-                i += 1
-        if is_new:
-            lines.append(v)
-            labels.append(Set([r]))
-
-    # Adjust the labels because we are missing rows.
-    fix_sets = lambda F: lambda S: Set(list(map(lambda s: F(s), S)))
-    for k in rows:
-        adjust = lambda i: i + (k <= i)*1
-        labels = list(map(fix_sets(adjust), labels))
-    labels = [Set(rows)] + labels 
-
-    # Adjust the row labels to hyperplane labels
+        key = _projective_key(M[r])
+        if key is None:
+            continue
+        if key in lines:
+            lines[key].append(r)
+        else:
+            lines[key] = [r]
+    groups = list(lines.values())
+
+    # Adjust the row labels to hyperplane labels, recalling that the rows of
+    # M are the rows of the original matrix not in rows.
+    D = L._data
+    A = list(L.hyperplane_arrangement)
     HL = L.hyperplane_labels
-    A = L.hyperplane_arrangement
-    HL_lab = lambda i: list(filter(lambda j: HL[j] == A[i], HL.keys()))[0]
-    labels = list(map(fix_sets(HL_lab), labels))
+    index = {A[k] : k for k in range(len(A))}
+    row_lab = {index[HL[j]] : j for j in HL}
+    skip = set(rows)
+    others = [k for k in range(len(A)) if not k in skip]
+    to_mask = lambda G: D.mask_of([row_lab[others[r]] for r in G])
+    masks = list(map(to_mask, groups))
 
     # Get the new hyperplanes
-    FL = L.flat_labels
-    new_hyp = [labels[k].union(labels[0]) for k in range(1, len(labels))]
-    P = L.poset
-    flat = lambda S: list(filter(lambda j: FL[j] == S, P.upper_covers(x)))[0]
-    new_hyp = list(map(flat, new_hyp))
-
-    def last_adj(S):
-        l_hyp = labels[1:]
-        T = S.difference(labels[0])
-        new_T = Set([])
-        for k in range(len(l_hyp)):
-            if l_hyp[k].issubset(T):
-                new_T = new_T.union(Set([new_hyp[k]]))
-        return new_T
-
-    return Matrix(lines),last_adj,{new_hyp[i] : i for i in range(len(new_hyp))}
+    m0 = D.masks[D.index[x]]
+    new_hyp = [D.position_of_mask(m | m0) for m in masks]
+
+    return Matrix(M.base_ring(), [M[G[0]] for G in groups], ncols=M.ncols()), masks, new_hyp
+
+# Returns the restriction of the arrangement of L to the flat in position y,
+# given the coefficient rows of its hyperplanes and the positions of the
+# covers of y labeling them, together with the hyperplane labels.
+def _restricted_arrangement(L, rows, covers, y):
+    from sage.all import HyperplaneArrangements
+    A = L.hyperplane_arrangement
+    D = L._data
+    d = A.dimension() - D.ranks[y]
+    HH = HyperplaneArrangements(A.base_ring(), A.parent().variable_names()[:d])
+    new_A = HH([list(v) for v in rows]) if len(rows) > 0 else HH()
+    by_key = {_projective_key(H.coefficients()) : H for H in new_A}
+    new_HL = {
+        D.elements[covers[k]] : by_key[_projective_key(rows[k])] 
+        for k in range(len(rows))
+    }
+    return new_A, new_HL
 
+# Returns the coefficient rows and the covers labeling them of the restriction
+# to the flat y, given those of the restriction to a flat covered by y. The
+# restriction to y is the restriction of the latter to the row of y, so one
+# variable is eliminated with this row. Rows that become parallel are grouped
+# by their normalized vectors, and the group of rows labeled by the covers c
+# gives the cover of y whose mask is the union of the masks of y and c.
+def _restrict_rows(D, rows, covers, y):
+    from sage.all import vector
+    k = covers.index(y)
+    v = rows[k]
+    j = next(i for i in range(1, len(v)) if v[i] != 0)
+    groups = {}
+    for r in range(len(rows)):
+        if r == k:
+            continue
+        w = rows[r] - (rows[r][j]/v[j])*v
+        w = w[:j].list() + w[j + 1:].list()
+        key = _projective_key(w)
+        if key is None:
+            continue
+        if key in groups:
+            groups[key] |= D.masks[covers[r]]
+        else:
+            groups[key] = D.masks[y] | D.masks[covers[r]]
+    K = v.base_ring()
+    new_rows = [vector(K, key) for key in groups]
+    new_covers = [D.position_of_mask(m) for m in groups.values()]
+    return new_rows, new_covers
+
+# Returns a dictionary from the given positions, which must be closed under
+# taking lower covers, to the pairs (rows, covers) of the restrictions of the
+# arrangement of L. These are computed in rank order, each derived from the
+# restriction to a flat it covers.
+def _batch_restrictions(L, positions):
+    from sage.all import vector
+    D = L._data
+    HL = L.hyperplane_labels
+    K = L.hyperplane_arrangement.base_ring()
+    atoms = D.atoms()
+    rows = [vector(K, HL[D.elements[a]].coefficients()) for a in atoms]
+    data = {0 : tuple([rows, atoms])}
+    for y in sorted(positions):
+        if y in data:
+            continue
+        x = next(i for i in D.lower_covers(y) if i in data)
+        data[y] = _restrict_rows(D, data[x][0], data[x][1], y)
+    return data
+
+# Returns the compact lattice of flats for the poset P with flat labels FL.
+def _compact_from_poset(P, FL):
+    hyps = sorted(_reduce(lambda x, y: x.union(set(y)), FL.values(), set()))
+    bit = {hyps[k] : k for k in range(len(hyps))}
+    to_mask = lambda S: sum(1 << bit[a] for a in S)
+    masks = {x : to_mask(FL[x]) for x in P._elements}
+    return CompactLattice.from_covers(
+        P._elements, P.cover_relations_iterator(), masks, hyps
+    )
+
+# Returns the compact lattice D with its flats renamed 0, 1, 2, ... in the
+# canonical order: by rank, and then by the sorted tuple of hyperplanes
+# containing the flat. If perm is given, bit j is first moved to bit perm[j].
+# All lattice-construction engines agree after this step.
+def _canonical_compact(D, perm=None):
+    if perm is None:
+        new_masks = list(D.masks)
+    else:
+        new_masks = [sum(1 << perm[j] for j in _bits(m)) for m in D.masks]
+    order = sorted(
+        range(len(D)), key=lambda i: (D.ranks[i], tuple(_bits(new_masks[i])))
+    )
+    name = {order[k] : k for k in range(len(order))}
+    covers = [
+        [name[i], name[j]] for i in range(len(D)) for j in D.upper_covers(i)
+    ]
+    masks = {name[i] : new_masks[i] for i in range(len(D))}
+    return CompactLattice.from_covers(
+        range(len(D)), covers, masks, range(1, len(D.hyperplanes) + 1)
+    )
+
+# Returns the flat labels of the poset P: the sets of atoms below each
+# element. The sets are integer bitsets over the atoms, computed along a linear
+# extension of P as the OR of the bitsets of the lower covers.
 def _parse_poset(P):
-    global POS, atoms, labs, int_at
     from sage.all import Set
-    import sage.parallel.decorate as para
-    
-    POS = P
-    N = _N
-    atoms = POS.upper_covers(POS.bottom())
-
-    @para.parallel(N)
-    def atom_set(k, shift): 
-        S = list(POS._elements[1+shift::k])
-        m = lambda x: [x, Set(list(filter(lambda a: POS.le(a, x), atoms)))]
-        return list(map(m, S))
-
-    labs = list(atom_set([(N, k) for k in range(N)]))
-    labs = [[P.bottom(), Set([])]] + _reduce(lambda x, y: x + y[1], labs, [])
-    label_dict = {T[0] : T[1] for T in labs}
-
-    return label_dict
-
-# Can return the subarrangement A_x or restriction A^x simply based on the
-# function F given. For subarrangement use 'lambda z: P.lower_covers(z)' and for
-# restriction use 'lambda z: P.upper_covers(z)'.
-def _subposet(P, x, F):
-    from sage.all import Set, Poset
-    elts = Set([])
-    new_level = Set([x])
-    while len(elts.union(new_level)) > len(elts):
-        elts = elts.union(new_level)
-        new_level = Set(_reduce(
-            lambda x, y: x+y, 
-            map(F, new_level), 
-            []
-        ))
-    new_P = P.subposet(elts)
-    return new_P
+    atoms = P.upper_covers(P.bottom())
+    bit = {atoms[k] : 1 << k for k in range(len(atoms))}
+    below = {}
+    for x in P.linear_extension():
+        b = bit.get(x, 0)
+        for y in P.lower_covers(x):
+            b |= below[y]
+        below[x] = b
+    return {x : Set([atoms[k] for k in _bits(b)]) for x, b in below.items()}
+
 
+# Returns a hashable key of the affine subspace U: equal subspaces have equal
+# keys. The key is given by the reduced echelon basis of the linear part of U
+# together with the point of U that vanishes on the pivots of this basis.
+def _subspace_key(U):
+    B = U.linear_part().echelonized_basis_matrix()
+    p = U.point()
+    for row, c in zip(B.rows(), B.pivots()):
+        p = p - p[c]*row
+    return tuple([B.nrows(), tuple(B.list()), tuple(p)])
 
-# Parallel function to build the intersection lattice.
+
+# Parallel function to build the intersection lattice. Here HS is the list of
+# affine subspaces of the hyperplanes, computed once by the caller. For each
+# new intersection, we also return the indices of the intersections in LIN
+# that it covers.
 # Moved to global to prevent accidentally carrying unnecessary data. 
 @_para.parallel(_N)
-def build_next(A, S, HYP, LIN):
-    from sage.all import exists, Set
+def build_next(HS, S, HYP, LIN):
+    from sage.all import Set
     new_level = []
     new_hypcont = []
+    new_parents = []
+    # Maps the canonical key of each new intersection to its index.
+    index = {}
     if len(S) > 0:
         m = S[0]
     for i in S:
         T = LIN[i - m]
-        for j in range(len(A)):
+        # The indices of the intersections with T found so far.
+        found = []
+        for j in range(len(HS)):
             # Skip the hyperplane already known to contain the intersection.
-            if not j in HYP[i - m]: 
-                H = A[j]
-                I = H._affine_subspace().intersection(T)
-                # Check if the intersection is trivial.
-                if I is not None:
-                    if I == T: 
-                        # This case means that H cap T = T, so we should
-                        # record that H contains T.
-                        HYP[i - m] = HYP[i - m].union(Set([j]))
-                    else:
-                        # Check if we have this intersection already. 
-                        is_in, ind = exists(
-                            range(len(new_level)), 
-                            lambda k: I == new_level[k]
-                        )
-                        if is_in:
-                            # We have the intersection, so we update
-                            # containment info accordingly. 
-                            new_hypcont[ind] = new_hypcont[ind].union(
-                                Set([j]).union(HYP[i - m])
-                            )
-                        else:
-                            # We do not have it, so we update everything.
-                            new_level.append(I)
-                            new_hypcont.append(HYP[i - m].union(Set([j])))
-    return list(zip(new_level, new_hypcont))
-
-
-# We expand on the function in sage, optimizing a little bit. This makes little
-# difference in small ranks but noticeable difference in larger ranks. This is
-# still quite slow. 
-def _para_intersection_poset(A):
+            if j in HYP[i - m]:
+                continue
+            # If H contains an intersection with T found before, then this is
+            # the intersection of H and T.
+            if any(j in new_hypcont[k] for k in found):
+                continue
+            I = HS[j].intersection(T)
+            # Check if the intersection is trivial.
+            if I is None:
+                continue
+            if I.dimension() == T.dimension():
+                # This case means that H cap T = T, so we should record that
+                # H contains T.
+                HYP[i - m] = HYP[i - m].union(Set([j]))
+                continue
+            key = _subspace_key(I)
+            if key in index:
+                # We have the intersection, so we update containment info
+                # accordingly. 
+                k = index[key]
+                new_hypcont[k] = new_hypcont[k].union(
+                    Set([j]).union(HYP[i - m])
+                )
+                new_parents[k].add(i)
+            else:
+                # We do not have it, so we update everything.
+                k = len(new_level)
+                index[key] = k
+                new_level.append(I)
+                new_hypcont.append(HYP[i - m].union(Set([j])))
+                new_parents.append(set([i]))
+            found.append(k)
+        # Hyperplanes found to contain T also contain its intersections.
+        for k in found:
+            new_hypcont[k] = new_hypcont[k].union(HYP[i - m])
+    return list(zip(new_level, new_hypcont, new_parents))
+
+
+# We expand on the function in sage, optimizing a little bit. The flats of
+# rank r are the intersections of the flats of rank r - 1 with the
+# hyperplanes, and these are computed in parallel. The output is the compact
+# lattice of flats together with the hyperplane labels.
+def _para_intersection_poset(A, verbose=_print):
     from sage.geometry.hyperplane_arrangement.affine_subspace import AffineSubspace
-    from sage.all import exists, flatten, Set, QQ, VectorSpace, Poset
+    from sage.all import Set, VectorSpace
     from .Globals import __SANITY
 
     N = _N
@@ -182,96 +283,317 @@ def _para_intersection_poset(A):
     # hyp_cont is the ranked list describing which hyperplanes contain the
     # corresponding intersection. 
     hyp_cont = [[Set([])], [Set([k]) for k in range(len(A))]]
+    # parents is the ranked list of the indices of the lower covers in the
+    # previous rank.
+    parents = [[set()], [set([0]) for k in range(len(A))]]
 
     c = A.is_central()*(-1)
     for r in range(2, A.rank() + c + 1):
-        print("{1}Working on elements of rank {0}".format(r, _time()))
+        if verbose:
+            print("{1}Working on elements of rank {0}".format(r, _time()))
         m = len(L[r-1])
         pmax = lambda k: (k+1)*(m//N) + (k==N-1)*(m%N)
         pmin = lambda k: k*(m//N)
         all_input = lambda k: tuple([
-            A, range(pmin(k), pmax(k)), 
+            L[1], range(pmin(k), pmax(k)), 
             hyp_cont[r - 1][pmin(k):pmax(k)], L[r - 1][pmin(k):pmax(k)]
         ])
         data = list(build_next(
             [all_input(k) for k in range(N) if pmin(k) != pmax(k)]
         ))
         data = _reduce(lambda x, y: x + y[1], data, [])
-        new_lev, new_hyp = list(zip(*data))
-        new_lev = list(new_lev)
-        new_hyp = list(new_hyp)
-        i = 0
-        # Merge the lists down
-        print("{0}Merging the lists from the {1} workers".format(_time(), N))
-        # First we check the affine spaces
-        while i < len(new_lev):
-            U = new_lev[i]
-            B1 = U.linear_part().basis_matrix()
-            p1 = U.point()
-            j = i + 1
-            while j < len(new_lev):
-                V = new_lev[j]
-                B2 = V.linear_part().basis_matrix()
-                p2 = V.point()
-                if B1 == B2 and p1 == p2:
-                    new_lev = new_lev[:j] + new_lev[j+1:]
-                    new_hyp[i] = new_hyp[i].union(new_hyp[j])
-                    new_hyp = new_hyp[:j] + new_hyp[j+1:]
-                else:
-                    j += 1
-            i += 1
-        # Second we check the labels of intersection (don't want duplicates)
-        i = 0
-        while i < len(new_lev):
-            j = i + 1
-            while j < len(new_lev):
-                if new_hyp[i] == new_hyp[j]:
-                    new_lev = new_lev[:j] + new_lev[j+1:]
-                    new_hyp = new_hyp[:j] + new_hyp[j+1:]
-                else:
-                    j += 1
-            i += 1
-        L.append(new_lev)
-        hyp_cont.append(new_hyp)
+        # Merge the lists down. First we identify equal affine subspaces by
+        # their canonical keys, and second we remove duplicate labels.
+        if verbose:
+            print("{0}Merging the lists from the {1} workers".format(_time(), N))
+        merged = {}
+        for U, S, C in data:
+            key = _subspace_key(U)
+            if key in merged:
+                merged[key][1] = merged[key][1].union(S)
+                merged[key][2] = merged[key][2].union(C)
+            else:
+                merged[key] = [U, S, C]
+        by_label = {}
+        for U, S, C in merged.values():
+            label = frozenset(S)
+            if label in by_label:
+                by_label[label][2] = by_label[label][2].union(C)
+            else:
+                by_label[label] = [U, S, C]
+        L.append([U for U, _, _ in by_label.values()])
+        hyp_cont.append([S for _, S, _ in by_label.values()])
+        parents.append([C for _, _, C in by_label.values()])
 
     # A silly optimization for centrals.
     if A.is_central() and len(A) > 1:
         inter = lambda X, Y: X.intersection(Y._affine_subspace())
         L.append([_reduce(inter, A[1:], A[0]._affine_subspace())])
         hyp_cont.append([Set(list(range(len(A))))])
-
-    L_flat = list(_reduce(lambda x, y: x + y, L, []))
-    hc_flat = list(_reduce(lambda x, y: x + y, hyp_cont, []))
+        parents.append([set(range(len(L[-2])))])
 
     # Sanity checks
     if __SANITY:
+        L_flat = list(_reduce(lambda x, y: x + y, L, []))
+        hc_flat = list(_reduce(lambda x, y: x + y, hyp_cont, []))
         print("{0}Running sanity check".format(_time()))
         assert len(L_flat) == len(hc_flat)
-        for i in range(len(hc_flat)):
-            for j in range(i+1, len(hc_flat)): 
-                assert hc_flat[i] != hc_flat[j], "{0} vs {1}".format(i, j)
+        assert len(set(map(frozenset, hc_flat))) == len(hc_flat)
         for i in range(len(L_flat)):
             I = list(map(lambda x: A[x], hc_flat[i]))
             U = _reduce(lambda x, y: x.intersection(y._affine_subspace()), I, whole_space)
             assert U == L_flat[i], "{0} vs {1}".format(U, L_flat[i])
 
-    print("{0}Constructing lattice of flats".format(_time()))
-    t = {}
-    for i in range(len(hc_flat)):
-        t[i] = Set(list(map(lambda x: x+1, hc_flat[i])))
-    cmp_fn = lambda p, q: t[p].issubset(t[q])
-    label_dict = {i : t[i] for i in range(len(hc_flat))}
-    get_hyp = lambda i: A[label_dict[i].an_element() - 1]
-    hyp_dict = {i + 1 : get_hyp(i + 1) for i in range(len(A))}
+    if verbose:
+        print("{0}Constructing lattice of flats".format(_time()))
+    # The position of the first flat of each rank.
+    offset = [0]
+    for level in hyp_cont:
+        offset.append(offset[-1] + len(level))
+    masks = {}
+    covers = []
+    for r in range(len(hyp_cont)):
+        for i in range(len(hyp_cont[r])):
+            x = offset[r] + i
+            masks[x] = sum(1 << k for k in hyp_cont[r][i])
+            covers += [[offset[r - 1] + j, x] for j in sorted(parents[r][i])]
+    D = CompactLattice.from_covers(
+        range(offset[-1]), covers, masks, range(1, len(A) + 1)
+    )
+    hyp_dict = {k + 1 : A[k] for k in range(len(A))}
+    return [_canonical_compact(D), hyp_dict]
+
 
-    return [Poset((t, cmp_fn)), label_dict, hyp_dict]
+# Reduces the vector v modulo the span B, given as a list of pairs (c, row)
+# in echelon form: row has entry 1 in position c, and entry 0 in the pivot
+# positions of the earlier rows.
+def _reduce_vector(v, B):
+    for c, row in B:
+        if v[c] != 0:
+            v = v - v[c]*row
+    return v
+
+# Returns the normalized direction (c, w) of the nonzero vector v: c is the
+# first nonzero position of v, and w is the multiple of v with w[c] = 1.
+def _direction(v):
+    c = v.nonzero_positions()[0]
+    return c, v/v[c]
+
+# Returns the flats covering the flat F, together with their spans, where B is
+# the span of F and V is the list of vectors of the hyperplanes. The hyperplane
+# g is in the closure of F and h if and only if the residues of g and h modulo
+# the span of F are parallel. Hence the flats covering F correspond to the
+# directions of the residues, except for the direction of the residue of e0,
+# which gives empty intersections.
+def _covering_flats(F, B, V, e0):
+    classes = {}
+    for g in range(len(V)):
+        if (F >> g) & 1:
+            continue
+        c, w = _direction(_reduce_vector(V[g], B))
+        key = tuple(w)
+        if key in classes:
+            classes[key][0] |= 1 << g
+        else:
+            classes[key] = [F | (1 << g), c, w]
+    empty = tuple(_direction(_reduce_vector(e0, B))[1])
+    return [
+        tuple([G, B + [tuple([c, w])]]) 
+        for key, (G, c, w) in classes.items() if key != empty
+    ]
+
+# The version of _covering_flats modulo the prime p. Here the vectors are the
+# rows of the NumPy array V of integers modulo p, and all residues are reduced
+# at once. If some residue vanishes, then p does not reflect the rank function
+# over the rationals, and we return None.
+def _covering_flats_mod(F, B, V, e0, p):
+    import numpy
+    rest = [g for g in range(len(V)) if not (F >> g) & 1]
+    R = numpy.vstack([V[rest], e0[None, :]])
+    for c, row in B:
+        R = (R - numpy.outer(R[:, c], row)) % p
+    first = (R != 0).argmax(axis=1)
+    lead = R[numpy.arange(len(R)), first]
+    if (lead == 0).any():
+        return None
+    inv = numpy.array([pow(int(a), p - 2, p) for a in lead], dtype=numpy.int64)
+    W = (R*inv[:, None]) % p
+    classes = {}
+    for k in range(len(rest)):
+        key = W[k].tobytes()
+        if key in classes:
+            classes[key][0] |= 1 << rest[k]
+        else:
+            classes[key] = [F | (1 << rest[k]), first[k], W[k]]
+    empty = W[-1].tobytes()
+    return [
+        tuple([G, B + [tuple([c, w])]]) 
+        for key, (G, c, w) in classes.items() if key != empty
+    ]
+
+# Enumerates the flats rank by rank, where covering(F, B) returns the flats
+# covering F together with their spans, given the span B of F. The flats of
+# rank r + 1 are the closures of a flat of rank r together with one more
+# hyperplane, and each such pair is a cover relation. Each rank is kept as a
+# dictionary from the bitmasks of the flats to their positions and spans, so
+# the span of a flat is computed once, from the first flat it covers. Returns
+# the list of bitmasks and the cover relations, or None if covering does. The
+# enumeration starts from the pair (mask, span) given by bottom, so it can also
+# list the flats above a given flat.
+def _closure_enumeration(covering, verbose=_print, bottom=(0, [])):
+    masks = [bottom[0]]
+    covers = []
+    level = {bottom[0] : tuple([0, bottom[1]])}
+    while len(level) > 0:
+        if verbose:
+            print("{0}Flats found: {1}".format(_time(), len(masks)))
+        new_level = {}
+        for F, (x, B) in level.items():
+            above = covering(F, B)
+            if above is None:
+                return None
+            for G, B_G in above:
+                if not G in new_level:
+                    new_level[G] = tuple([len(masks), B_G])
+                    masks.append(G)
+                covers.append([x, new_level[G][0]])
+        level = new_level
+    return masks, covers
+
+# Returns a number field F and the vectors V over F, or (None, None) if the
+# entries of V do not lie in a number field other than the rationals. Elements
+# of the universal cyclotomic field are moved to the smallest cyclotomic field
+# containing all of them, where arithmetic is much faster.
+def _number_field_vectors(K, V):
+    from sage.all import UniversalCyclotomicField, CyclotomicField, NumberFields
+    from sage.all import QQ, lcm, vector
+    if isinstance(K, UniversalCyclotomicField):
+        N = lcm([
+            a.to_cyclotomic_field().parent().zeta_order() for v in V for a in v
+        ])
+        F = CyclotomicField(N)
+        return F, [vector(F, [a.to_cyclotomic_field(F) for a in v]) for v in V]
+    if K != QQ and K in NumberFields():
+        return K, V
+    return None, None
+
+# Returns a random prime p below 2^31 together with the NumPy array of the
+# images of the vectors V over the number field F under a ring homomorphism to
+# the integers modulo p. The generator of F is sent to a root of its defining
+# polynomial modulo p.
+def _reduce_mod_prime(F, V):
+    import numpy
+    from sage.all import GF, random_prime
+    f = F.polynomial()
+    while True:
+        p = random_prime(2**31, lbound=2**30)
+        k = GF(p)
+        try:
+            roots = f.change_ring(k).roots(multiplicities=False)
+            if len(roots) == 0:
+                continue
+            r = roots[0]
+            V_p = [[int(a.polynomial().change_ring(k)(r)) for a in v] for v in V]
+        except ZeroDivisionError:
+            continue
+        return p, numpy.array(V_p, dtype=numpy.int64)
+
+# Checks that the flats found modulo a prime have the expected ranks over the
+# field F of the vectors V. Modulo a prime, a nonzero residue is nonzero over F,
+# so the only possible errors are hyperplanes that were wrongly put into the
+# closure of a flat, and these increase the rank of the flat over F.
+def _certify_ranks(masks, covers, F, V):
+    from sage.all import Matrix
+    rank = [0]*len(masks)
+    for x, y in covers:
+        rank[y] = rank[x] + 1
+    for i in range(1, len(masks)):
+        if Matrix(F, [V[g] for g in _bits(masks[i])]).rank() != rank[i]:
+            return False
+    return True
+
+# Returns the compact lattice of flats of A. A hyperplane is given by its
+# vector of coefficients (a_0, a_1, ..., a_d), and the intersection of a set of
+# hyperplanes is empty if and only if the vector e0 = (1, 0, ..., 0) is in the
+# span of their vectors. For central arrangements, over the rationals or
+# other number fields, we work modulo one random prime and certify the ranks
+# of the flats exactly. For affine arrangements over the rationals, we work
+# modulo two random primes below 2^31. Modulo a prime, ranks can only drop,
+# and if the two primes give the same flats and covers, we use them; this is
+# correct with high probability but not certified. Otherwise, we fall back to
+# exact arithmetic.
+def _lof_from_closure(A, verbose=_print):
+    from sage.all import vector, QQ
+    import numpy
+    K = A.base_ring()
+    n = len(A)
+    if n == 0:
+        D = CompactLattice.from_covers([0], [], {0 : 0}, [])
+        return [D, {}]
+    e0 = vector(K, [1] + [0]*A.dimension())
+    V = [vector(K, H.coefficients()) for H in A]
+    e0_p = numpy.array([1] + [0]*A.dimension(), dtype=numpy.int64)
+
+    result = None
+    F, V_F = _number_field_vectors(K, V)
+    if K == QQ:
+        from sage.all import random_prime, lcm
+        ints = [v*lcm([a.denominator() for a in v]) for v in V]
+        results = []
+        for _ in range(1 if A.is_central() else 2):
+            p = random_prime(2**31, lbound=2**30)
+            V_p = numpy.array([[int(a) % p for a in v] for v in ints], dtype=numpy.int64)
+            covering = lambda F, B: _covering_flats_mod(F, B, V_p, e0_p, p)
+            results.append(_closure_enumeration(covering, verbose=verbose))
+        if results[0] != None and all(R == results[0] for R in results):
+            result = results[0]
+        if result != None and A.is_central():
+            if not _certify_ranks(result[0], result[1], QQ, V):
+                result = None
+    elif F != None and A.is_central() and n > 0:
+        p, V_p = _reduce_mod_prime(F, V_F)
+        covering = lambda G, B: _covering_flats_mod(G, B, V_p, e0_p, p)
+        result = _closure_enumeration(covering, verbose=verbose)
+        if result != None and not _certify_ranks(result[0], result[1], F, V_F):
+            result = None
+    if result is None:
+        if verbose:
+            print("{0}Using exact arithmetic".format(_time()))
+        if F != None:
+            V = V_F
+            e0 = vector(F, e0)
+        covering = lambda G, B: _covering_flats(G, B, V, e0)
+        result = _closure_enumeration(covering, verbose=verbose)
+
+    masks, covers = result
+    D = CompactLattice.from_covers(
+        range(len(masks)), covers, dict(enumerate(masks)), range(1, n + 1)
+    )
+    hyp_dict = {k + 1 : A[k] for k in range(n)}
+    return [_canonical_compact(D), hyp_dict]
+
+
+# Chooses the lattice-construction engine for the arrangement A. Sage's
+# matroid code is hard to beat on small arrangements. Larger arrangements over
+# the rationals, and central arrangements over other number fields, use the
+# closure engine, which works modulo primes.
+def _auto_engine(A):
+    from sage.all import QQ
+    if A.rank() <= 2:
+        return 'matroid'
+    if A.base_ring() == QQ:
+        return 'closure' if len(A) >= 16 else 'matroid'
+    F, _ = _number_field_vectors(A.base_ring(), [])
+    if F != None and A.is_central():
+        return 'closure'
+    return 'matroid'
 
 
 # Default SageMath algorithm works well. However 'A.matroid()' seems to remove
-# ordering, which we depend on, so care is needed. 
+# ordering, which we depend on, so care is needed. The output is the compact
+# lattice of flats together with the hyperplane labels.
 def _lof_from_matroid(A=None, matroid=None):
-    from sage.all import Set, Matrix, Matroid, Poset
-    from functools import reduce
+    from sage.all import Matrix, Matroid
     if A != None:
         rows = list(map(lambda H: H.coefficients()[1:], A.hyperplanes()))
         mat = Matrix(A.base_ring(), rows).transpose()
@@ -290,91 +612,381 @@ def _lof_from_matroid(A=None, matroid=None):
         map(lbl_map, filter(lambda x: L.rank(x) == r, L._elements))
     )
     rank_1 = [frozenset([k]) for k in range(n)]
-    ranks = reduce(
+    ranks = _reduce(
         lambda x, y: x + y, 
         [rank_r(L, r) for r in range(2, L.rank() + 1)], 
-        [L.bottom()] + rank_1
+        [frozenset()] + rank_1
     )
-    P = Poset(
-        L, element_labels={x : ranks.index(lbl_map(x)) for x in L._elements}
+    # Flat i contains hyperplane k + 1 if and only if bit k is set.
+    index = {ranks[i] : i for i in range(len(ranks))}
+    to_mask = lambda S: sum(1 << k for k in S)
+    masks = {i : to_mask(ranks[i]) for i in range(len(ranks))}
+    covers = [
+        [index[lbl_map(a)], index[lbl_map(b)]] 
+        for a, b in L.cover_relations_iterator()
+    ]
+    D = CompactLattice.from_covers(
+        range(len(ranks)), covers, masks, range(1, n + 1)
     )
-    adj_set = lambda S: Set([x+1 for x in S])
-    label_dict = {i : adj_set(ranks[i]) for i in range(len(L))}
+    D = _canonical_compact(D)
     if A != None:
-        hyp_dict = {i : A[list(ranks[i])[0]] for i in range(1, n + 1)}
+        hyp_dict = {i : A[i - 1] for i in range(1, n + 1)}
     else: 
         hyp_dict = None 
-    return [P, label_dict, hyp_dict]
+    return [D, hyp_dict]
+
+
+# Removes bit e from the integer m, shifting the higher bits down by one.
+def _drop_bit(m, e):
+    low = m & ((1 << e) - 1)
+    return low | ((m >> (e + 1)) << e)
 
 
 def _lof_from_affine_matroid(A):
-    from sage.all import Poset, Set 
-    from functools import reduce
     A_coned = A.cone()
     hyps = list(map(lambda H: H.coefficients(), A_coned.hyperplanes()))
     extra = [0, 1] + [0]*(A.dimension())
     i = hyps.index(extra)
-    P, L, H = _lof_from_matroid(A_coned)
+    D, H = _lof_from_matroid(A_coned)
     assert (H[i + 1]).coefficients() == extra 
-    new_elts = list(filter(lambda x: not P.le(i + 1, x), P))
-    new_elts = reduce(
-        lambda x, y: x + y,
-        [list(filter(lambda x: P.rank(x) == r, new_elts)) for r in range(2, P.rank() + 1)],
-        [0] + [j for j in range(1, len(A_coned) + 1) if j != i + 1]
+    e = D.bit(i + 1)
+    # Keep the flats not contained in the hyperplane at infinity.
+    keep = [j for j in range(len(D)) if not (D.masks[j] >> e) & 1]
+    masks = [_drop_bit(D.masks[j], e) for j in keep]
+    D_sub = D.sub(keep, masks=masks)
+    D_new = CompactLattice(
+        list(range(len(keep))), D_sub.ranks, masks, 
+        (D_sub.up_ptr, D_sub.up_idx), (D_sub.down_ptr, D_sub.down_idx),
+        list(range(1, len(A) + 1))
     )
-    new_names = {x : new_elts.index(x) for x in new_elts}
-    adj_set = lambda S: Set([new_names[x] for x in S if x in new_elts])
-    P_new = Poset(P.subposet(new_elts), element_labels=new_names)
-    L_new = {new_names[x] : adj_set(L[x]) for x in new_elts}
-    def inv_H(h): 
-        cut = lambda x: x.coefficients()[1:]
-        pair = list(filter(lambda x: cut(x[1]) == h, H.items())) 
-        return pair[0][0]
-    H_new = {new_names[inv_H(h.coefficients())] : h for h in A}
-    return [P_new, L_new, H_new]
+    cut = {tuple(hyps[k][1:]) : k + 1 for k in range(len(hyps))}
+    new_names = {D.elements[keep[k]] : k for k in range(len(keep))}
+    H_new = {new_names[cut[tuple(h.coefficients())]] : h for h in A}
+    # Relabel the hyperplanes so that bit k corresponds to A[k].
+    A_hyps = list(A)
+    perm = {}
+    for a in D_new.atoms():
+        j = next(_bits(D_new.masks[a]))
+        perm[j] = A_hyps.index(H_new[D_new.elements[a]])
+    D_new = _canonical_compact(D_new, perm=perm)
+    return [D_new, {k + 1 : A_hyps[k] for k in range(len(A_hyps))}]
+
+
+# Returns the compact lattice of flats and the hyperplane labels of the
+# arrangement A, which is the arrangement of L with the hyperplane H added. The
+# masks and covers of L are kept, and H gets the highest bit. The flats
+# containing H are enumerated from H with the closure engine; such a flat G is
+# an old flat if the old flat with the mask of G without H has the same rank,
+# and otherwise G is new. In the latter case, this old flat has rank one less
+# and it is the only flat not containing H that G covers. Finally, the flats
+# are sorted and hyperplane k + 1 is A[k], as for LatticeOfFlats(A).
+def _lof_add_hyperplane(L, H, A):
+    from sage.all import vector, Matrix
+    D = L._data
+    HL = L.hyperplane_labels
+    K = A.base_ring()
+    atoms = D.atoms()
+    n = len(atoms)
+    if all(D.masks[atoms[k]] == 1 << k for k in range(n)):
+        old_masks = D.masks
+    else:
+        atom_bit = {atoms[k] : 1 << k for k in range(n)}
+        old_masks = [
+            sum(atom_bit[a] for a in D.atoms_below(i)) for i in range(len(D))
+        ]
+    old_index = {old_masks[i] : i for i in range(len(D))}
+    hyps = [HL[D.elements[a]] for a in atoms] + [H]
+    V = [vector(K, G.coefficients()) for G in hyps]
+    e0 = vector(K, [1] + [0]*(len(V[-1]) - 1))
+    if any(Matrix(K, [v, V[-1]]).rank() == 1 for v in V[:-1]):
+        raise ValueError("Hyperplane already in the arrangement:\n{0}".format(H))
+    F, V_F = _number_field_vectors(K, V)
+    if F != None:
+        V = V_F
+        e0 = vector(F, e0)
+
+    h = 1 << n
+    covering = lambda G, B: _covering_flats(G, B, V, e0)
+    up_masks, up_covers = _closure_enumeration(
+        covering, verbose=False, bottom=(h, [_direction(V[-1])])
+    )
+    up_ranks = [1]*len(up_masks)
+    for x, y in up_covers:
+        up_ranks[y] = up_ranks[x] + 1
+
+    # The old flats keep their positions, and the new flats come after them.
+    masks = list(old_masks)
+    ranks = list(D.ranks)
+    up = [list(D.upper_covers(i)) for i in range(len(D))]
+    pos = []
+    is_new = set()
+    for k in range(len(up_masks)):
+        i = old_index[up_masks[k] & ~h]
+        if D.ranks[i] == up_ranks[k]:
+            pos.append(i)
+            masks[i] = up_masks[k]
+        else:
+            pos.append(len(masks))
+            is_new.add(k)
+            masks.append(up_masks[k])
+            ranks.append(up_ranks[k])
+            up.append([])
+            up[i].append(pos[k])
+    # Covers between two old flats are already old covers.
+    for x, y in up_covers:
+        if x in is_new or y in is_new:
+            up[pos[x]].append(pos[y])
+
+    # Move bit k to the position in A of the hyperplane it stands for.
+    index = {_projective_key(A[k].coefficients()) : k for k in range(len(A))}
+    perm = {k : index[_projective_key(hyps[k].coefficients())] for k in range(n + 1)}
+    masks = [sum(1 << perm[j] for j in _bits(m)) for m in masks]
+    order = sorted(
+        range(len(masks)), key=lambda i: (ranks[i], tuple(_bits(masks[i])))
+    )
+    name = [0]*len(order)
+    for k in range(len(order)):
+        name[order[k]] = k
+    covers = [[name[i], name[j]] for i in range(len(up)) for j in up[i]]
+    new_D = CompactLattice.from_covers(
+        range(len(masks)), covers, {name[i] : masks[i] for i in range(len(masks))},
+        range(1, n + 2)
+    )
+    return new_D, {k + 1 : A[k] for k in range(len(A))}
+
+
+# Returns a fingerprint of the hyperplane arrangement A: the base ring, the
+# dimension, and the sorted coefficient vectors, each scaled so that the first
+# nonzero coefficient of its linear part is 1. Arrangements with the same
+# fingerprint are equal. Only identical minors share a fingerprint: isomorphic
+# minors in other coordinates get different ones. Keying on the certificate
+# of the lattice would need the lattice of flats, which deletion-restriction
+# is meant to avoid.
+def _fingerprint(A):
+    rows = set(_projective_key(H.coefficients()) for H in A)
+    return tuple([A.base_ring(), A.dimension(), tuple(sorted(rows, key=str))])
+
+# An upper bound on the number of nodes of the deletion-restriction tree of A:
+# every path in the tree restricts at most rank many times. Beyond _dr_limit
+# nodes, it is cheaper to build the lattice of flats once.
+def _deletion_restriction_cost(A):
+    from sage.all import binomial
+    n = len(A)
+    return sum(binomial(n, k) for k in range(A.rank() + 1))
+
+
+# A cache holding at most size entries, where the least recently used entry is
+# evicted first.
+class _LRUCache():
+
+    def __init__(self, size):
+        self.size = size
+        self._entries = _OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return "A cache of {0} entries of at most {1}".format(len(self._entries), self.size)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        r"""
+        Return the number of hits and misses of the lookups so far.
+        """
+        return {'hits' : self.hits, 'misses' : self.misses}
+
+    def clear(self):
+        self._entries.clear()
+
+    def get(self, key):
+        if key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        self.misses += 1
+        return None
+
+    def save(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+# The Poincare polynomials of the minors met in deletion-restriction, shared by
+# all lattices of flats in this process and keyed by the fingerprints of the
+# arrangements.
+global minor_cache
+minor_cache = _LRUCache(_minor_size)
 
 
 class LatticeOfFlats():
 
     def __init__(self, A=None, poset=None, flat_labels=None, 
     hyperplane_labels=None, lazy=False, matroid=None, 
-    nature_hyperplane_label=True):
+    nature_hyperplane_label=True, engine='auto'):
+        self._view = None
+        self._interval = None
+        self._geometry = None
+        self._intervals = None
         self.hyperplane_arrangement = A
-        self.poset = poset 
-        self.flat_labels = flat_labels
+        self._poset = poset 
+        self._flat_labels = flat_labels
+        self._data = None
         self.hyperplane_labels = hyperplane_labels
         if poset != None:
             assert poset.has_bottom(), "Expected a unique minimal element in poset."
             assert poset.is_graded(), "Expected a graded poset."
-            self.poset = poset
+            if self._flat_labels == None and not lazy:
+                self._flat_labels = _parse_poset(poset)
+            if self._flat_labels != None:
+                self._data = _compact_from_poset(poset, self._flat_labels)
         else:
             if not lazy:
-                if A != None: 
-                    if A.is_central():
-                        P, FL, HL = _lof_from_matroid(A)
-                    else:
-                        P, FL, HL = _lof_from_affine_matroid(A)
-                else: 
-                    P, FL, HL = _lof_from_matroid(A=None, matroid=matroid)
-                self.poset = P
-                self.flat_labels = FL
+                if not engine in ['auto', 'matroid', 'intersection', 'closure']:
+                    raise ValueError("Unknown engine: {0}".format(engine))
+                if A != None and engine == 'auto':
+                    engine = _auto_engine(A)
+                if A == None: 
+                    if not engine in ['auto', 'matroid']:
+                        raise ValueError("Expected a hyperplane arrangement for the {0} engine.".format(engine))
+                    D, HL = _lof_from_matroid(A=None, matroid=matroid)
+                elif engine == 'intersection':
+                    D, HL = _para_intersection_poset(A)
+                elif engine == 'closure':
+                    D, HL = _lof_from_closure(A)
+                elif A.is_central():
+                    D, HL = _lof_from_matroid(A)
+                else:
+                    D, HL = _lof_from_affine_matroid(A)
+                self._data = D
                 self.hyperplane_labels = HL
-        if self.flat_labels == None and not lazy:
-            self.flat_labels = _parse_poset(poset)
         if self.hyperplane_arrangement != None and self.hyperplane_labels == None and nature_hyperplane_label:
             self.hyperplane_labels = {i + 1 : A[i] for i in range(len(A))}
 
+    # Builds a lattice of flats directly from its compact description.
+    @classmethod
+    def _from_data(cls, D, A=None, hyperplane_labels=None):
+        L = cls.__new__(cls)
+        L._view = None
+        L._interval = None
+        L._geometry = None
+        L._intervals = None
+        L.hyperplane_arrangement = A
+        L._poset = None
+        L._flat_labels = None
+        L._data = D
+        L.hyperplane_labels = hyperplane_labels
+        return L
+
+    # Builds a view of the interval of D on the given positions, with the
+    # given masks and hyperplanes, which shares the arrays of D. The compact
+    # lattice of the interval is only built when asked for, and geometry, if
+    # given, returns the hyperplane arrangement and its labels when asked for.
+    # The triple interval = (D, i, upper) records that the view is the
+    # interval above (or below) position i of D.
+    @classmethod
+    def _from_view(cls, D, positions, masks, hyperplanes, interval, geometry=None):
+        L = cls._from_data(None)
+        L._view = tuple([D, positions, masks, hyperplanes])
+        L._interval = interval
+        L._geometry = geometry
+        return L
+
+    # The compact lattice of a view or of a lazily given poset is only built
+    # when asked for.
+    @property
+    def _data(self):
+        if self._D is None and self._view is not None:
+            D, positions, masks, hyperplanes = self._view
+            self._D = D.sub(positions, masks=masks, hyperplanes=hyperplanes)
+            self._view = None
+        if self._D is None and self._poset is not None:
+            if self._flat_labels is None:
+                self._flat_labels = _parse_poset(self._poset)
+            self._D = _compact_from_poset(self._poset, self._flat_labels)
+        return self._D
+
+    @_data.setter
+    def _data(self, D):
+        self._D = D
+
+    # The hyperplane arrangement of a restriction is only built when asked for.
+    def _build_geometry(self):
+        if self._geometry is not None:
+            self._A, self._HL = self._geometry()
+            self._geometry = None
+
+    # Whether the lattice has a hyperplane arrangement, without building it.
+    def _has_geometry(self):
+        return self._geometry is not None or bool(self._A)
+
+    @property
+    def hyperplane_arrangement(self):
+        self._build_geometry()
+        return self._A
+
+    @hyperplane_arrangement.setter
+    def hyperplane_arrangement(self, A):
+        self._A = A
+
+    @property
+    def hyperplane_labels(self):
+        self._build_geometry()
+        return self._HL
+
+    @hyperplane_labels.setter
+    def hyperplane_labels(self, HL):
+        self._HL = HL
+
+    # The number of flats, without building the compact lattice of a view.
+    def _size(self):
+        if self._view is not None:
+            return len(self._view[1])
+        return len(self._data)
+
+    # The Sage poset and the flat labels are only built when asked for.
+    @property
+    def poset(self):
+        if self._poset is None and self._data is not None:
+            self._poset = self._data.to_poset()
+        return self._poset
+
+    @poset.setter
+    def poset(self, P):
+        self._poset = P
+
+    @property
+    def flat_labels(self):
+        from sage.all import Set
+        if self._flat_labels is None and self._data is not None:
+            D = self._data
+            self._flat_labels = {
+                D.elements[i] : Set(D.labels(D.masks[i])) 
+                for i in range(len(D))
+            }
+        return self._flat_labels
+
+    @flat_labels.setter
+    def flat_labels(self, FL):
+        self._flat_labels = FL
+
     def __repr__(self):
+        if self._poset is None and (self._view is not None or self._data is not None):
+            P = "Finite poset containing {0} elements".format(self._size())
+        else:
+            P = self.poset
         if self.hyperplane_arrangement:
-            return "The lattice of flats of:\n{0}\ngiven by:\n{1}".format(self.hyperplane_arrangement, self.poset)
+            return "The lattice of flats of:\n{0}\ngiven by:\n{1}".format(self.hyperplane_arrangement, P)
         else:
-            return "The lattice of flats of some matroid given by:\n{0}".format(self.poset)
+            return "The lattice of flats of some matroid given by:\n{0}".format(P)
 
     def _save(self, file, var_name='L'):
         from sage.all import Matrix
         HH = self.hyperplane_arrangement.parent()
         A = Matrix(map(lambda H: H.coefficients(), self.hyperplane_arrangement.hyperplanes())).rows()
-        CR = tuple(map(lambda T: tuple(T), self.poset.cover_relations()))
+        CR = tuple(map(lambda T: tuple(T), self._data.cover_relations()))
         FL = self.flat_labels
         FL_tup = tuple([tuple([x, list(FL[x])]) for x in FL.keys()])
         del FL 
@@ -388,7 +1000,7 @@ class LatticeOfFlats():
             del A
             F.write("CR = {0}\n".format(CR).replace("), ", "),\n"))
             del CR
-            F.write("P = Poset([range({0}), CR], cover_relations=True)\n".format(len(self.poset._elements)))
+            F.write("P = Poset([range({0}), CR], cover_relations=True)\n".format(len(self._data)))
             F.write("FL_tup = {0}\n".format(FL_tup).replace("), ", "),\n"))
             F.write(dict_builder)
             F.write("del FL_tup\n")
@@ -398,148 +1010,230 @@ class LatticeOfFlats():
 
 
     def atoms(self):
-        return self.poset.upper_covers(self.poset.bottom())
+        D = self._data
+        return [D.elements[i] for i in D.atoms()]
 
     def labels_of_flats(self):
-        elt_tup = lambda x: tuple([x, self.flat_labels[x]])
-        return list(map(elt_tup, self.poset._elements))
+        FL = self.flat_labels
+        elt_tup = lambda x: tuple([x, FL[x]])
+        return list(map(elt_tup, self._data.elements))
 
     def labels_of_hyperplanes(self):
-        P = self.poset 
         elt_tup = lambda x: tuple([x, self.hyperplane_labels[x]])
-        return list(map(elt_tup, P.upper_covers(P.bottom())))
+        return list(map(elt_tup, self.atoms()))
 
     def proper_part_poset(self):
-        P = self.poset
-        elts = list(P._elements)
-        if P.has_top():
-            elts.remove(P.top())
-        elts.remove(P.bottom())
-        return P.subposet(elts)
+        D = self._data
+        elts = list(range(1, len(D)))
+        if D.has_top():
+            elts.remove(D.top())
+        return D.to_poset(positions=elts)
 
     def show(self):
         self.poset.show()
 
-    def subarrangement(self, x):
-        P = self.poset 
+    # Returns the position of x in the compact lattice, where x is either an
+    # element of the poset or a set of hyperplane labels.
+    def _position(self, x):
+        D = self._data
         if type(x) != set:
-            assert x in P, "Expected element to be in poset."
-            new_P = _subposet(P, x, lambda z: P.lower_covers(z))
-            new_A = None 
-            new_FL = None
-            new_HL = None 
-            if self.hyperplane_arrangement and self.hyperplane_labels:
-                A = self.hyperplane_arrangement
-                HL = self.hyperplane_labels
-                atoms = new_P.upper_covers(new_P.bottom())
-                keep = list(map(lambda k: HL[k], atoms))
-                new_A = A.parent()(keep)
-                new_HL = {a : HL[a] for a in atoms}
-            if self.flat_labels:
-                FL = self.flat_labels
-                new_FL = {x : FL[x] for x in new_P._elements}
-            return LatticeOfFlats(new_A, poset=new_P, flat_labels=new_FL, hyperplane_labels=new_HL)
+            i = D.index.get(x)
         else:
-            L = self.flat_labels 
-            X = list(filter(lambda y: L[y] == x, P._elements))
             try:
-                return self.subarrangement(X[0])
-            except IndexError:
-                raise ValueError("No element labeled by:\n{0}".format(x))
+                i = D.position_of_mask(D.mask_of(x))
+            except KeyError:
+                i = None
+        if i is None:
+            raise ValueError("No element labeled by:\n{0}".format(x))
+        return i
+
+    # The subarrangements and restrictions are kept in a bounded cache on the
+    # lattice, so that all generating-function engines share them.
+    def _cached_interval(self, key, build):
+        if self._intervals is None:
+            self._intervals = _LRUCache(_interval_size)
+        L = self._intervals.get(key)
+        if L is None:
+            L = build()
+            self._intervals.save(key, L)
+        return L
+
+    def interval_cache_stats(self):
+        r"""
+        Return the number of hits and misses of the cache of subarrangements
+        and restrictions of the lattice, together with its size.
+        """
+        if self._intervals is None:
+            return {'hits' : 0, 'misses' : 0, 'size' : 0}
+        stats = self._intervals.stats()
+        stats['size'] = len(self._intervals)
+        return stats
+
+    def subarrangement(self, x):
+        i = self._position(x)
+        return self._cached_interval(
+            tuple(['sub', i]), lambda: self._subarrangement(i)
+        )
+
+    def restriction(self, x, geometric=True):
+        r"""
+        Return the lattice of flats of the restriction to x. If geometric is
+        False, the restricted arrangement is not computed: the flats are
+        labeled by the hyperplanes of the lattice not containing x, and no
+        linear algebra is done.
+        """
+        i = self._position(x)
+        return self._cached_interval(
+            tuple(['res', i, bool(geometric)]), 
+            lambda: self._restriction(i, geometric=geometric)
+        )
+
+    def _subarrangement(self, i):
+        D = self._data
+        down = D.down_set(i)
+        def geometry():
+            A = self.hyperplane_arrangement
+            HL = self.hyperplane_labels
+            atoms = D.labels(D.masks[i])
+            keep = list(map(lambda k: HL[k], atoms))
+            return A.parent()(keep), {a : HL[a] for a in atoms}
+        return LatticeOfFlats._from_view(
+            D, down, [D.masks[j] for j in down], D.hyperplanes, (D, i, False),
+            geometry=geometry if self._has_geometry() else None
+        )
     
-    def restriction(self, x):
-        from sage.all import Matrix, HyperplaneArrangements
-        P = self.poset 
-        if type(x) != set:
-            assert x in P, "Expected element to be in poset."
-            new_P = _subposet(P, x, lambda z: P.upper_covers(z))
-            new_A = None 
-            new_HL = None 
-            if self.hyperplane_arrangement:
-                A = self.hyperplane_arrangement
-                hyp_coeffs = map(lambda H: H.coefficients(), A.hyperplanes())
-                M = Matrix(A.base_ring(), list(hyp_coeffs))
-                rows = sorted(list(map(
-                    lambda H: list(A).index(self.hyperplane_labels[H]), 
-                    self.flat_labels[x]
-                )))
-                new_M = _contract(M, rows)
-                new_M, lab_func, hyp_dict = _get_labels(new_M, x, rows, self)
-                HH = HyperplaneArrangements(
-                    A.base_ring(), 
-                    A.parent().variable_names()[:new_M.ncols()-1]
-                )
-                new_A = HH(new_M)
-                FL = self.flat_labels
-                new_FL = {x : lab_func(FL[x]) for x in new_P._elements}
-                new_HL = {a : new_A[hyp_dict[a]] for a in new_P.upper_covers(new_P.bottom())}
-            else:
-                FL = self.flat_labels
-                new_FL = {y : FL[y].difference(FL[x]) for y in new_P._elements}
-            return LatticeOfFlats(new_A, poset=new_P, flat_labels=new_FL, hyperplane_labels=new_HL)
+    def restrictions(self, X=None):
+        r"""
+        Return a dictionary from the elements x, either all elements or those
+        in X, to the restrictions to x. The restricted arrangements are
+        computed together in rank order, each from the restriction to an
+        element covered by x.
+        """
+        D = self._data
+        if X is None:
+            positions = list(range(len(D)))
         else:
-            L = self.flat_labels 
-            X = list(filter(lambda y: L[y] == x, P._elements))
-            try:
-                return self.restriction(X[0])
-            except IndexError:
-                raise ValueError("No element labeled by:\n{0}".format(x))
-    
-    def deletion(self, H):
-        from sage.all import Set
+            positions = [self._position(x) for x in X]
+        if not self._has_geometry():
+            return {D.elements[i] : self.restriction(D.elements[i]) for i in positions}
+        below = 0
+        for i in positions:
+            below |= D.down_bits(i)
+        data = _batch_restrictions(self, list(_bits(below)))
+        def build(i):
+            rows, covers = data[i]
+            geometry = lambda: _restricted_arrangement(self, rows, covers, i)
+            return lambda: self._restriction(i, geometry=geometry)
+        # The restricted arrangements are built in other coordinates than by
+        # restriction, so they are cached under their own keys.
+        return {
+            D.elements[i] : self._cached_interval(tuple(['res', i, 'batch']), build(i))
+            for i in positions
+        }
 
-        P = self.poset
-        L = self.flat_labels
+    def _restriction(self, i, geometry=None, geometric=True):
+        D = self._data
+        x = D.elements[i]
+        up = D.up_set(i)
+        m0 = D.masks[i]
+        if not geometric or not self._has_geometry():
+            masks = [D.masks[j] & ~m0 for j in up]
+            return LatticeOfFlats._from_view(
+                D, up, masks, D.hyperplanes, (D, i, True)
+            )
 
-        if type(H) == set:
-            L = self.flat_labels 
-            X = list(filter(lambda y: L[y] == H, P._elements))
-            try:
-                return self.deletion(X[0])
-            except IndexError:
-                raise ValueError("No element labeled by:\n{0}".format(H))
-            
-        assert P.rank_function()(H) == 1, "Expected an atom."
-
-        if P.has_top():
-            coatoms = P.lower_covers(P.top())
-        else:
-            # not really coatoms... but whatever
-            coatoms = P.maximal_elements()
-
-        m = len(self.atoms()) - 1
-        def check(C):
-            S = L[C]
-            return bool(len(S) == m and not H in S)
-        new_top = list(filter(check, coatoms))
-
-        if len(new_top) == 1:
-            new_P = _subposet(P, new_top[0], lambda z: P.lower_covers(z))
-            new_FL = {y : L[y] for y in new_P._elements}
+        # The hyperplanes of the restriction correspond to the upper covers
+        # of x, and flat y contains the hyperplane of the cover c iff c <= y.
+        covers = D.upper_covers(i)
+        def new_mask(j):
+            return sum(
+                1 << k for k in range(len(covers)) if D.le(covers[k], j)
+            )
+        masks = [new_mask(j) for j in up]
+        new_labels = [D.elements[c] for c in covers]
+
+        def contract():
+            from sage.all import Matrix
+            A = self.hyperplane_arrangement
+            hyp_coeffs = map(lambda H: H.coefficients(), A.hyperplanes())
+            M = Matrix(A.base_ring(), list(hyp_coeffs))
+            index = {A[k] : k for k in range(len(A))}
+            HL = self.hyperplane_labels
+            rows = sorted([index[HL[H]] for H in D.labels(m0)])
+            new_M = _contract(M, rows)
+            new_M, _, new_hyp = _get_labels(new_M, x, rows, self)
+            return _restricted_arrangement(self, new_M.rows(), new_hyp, i)
+
+        if geometry is None:
+            geometry = contract
+        return LatticeOfFlats._from_view(
+            D, up, masks, new_labels, (D, i, True), geometry=geometry
+        )
+    
+    def deletion(self, H):
+        r"""
+        Return the lattice of flats of the arrangement without H, where H is
+        either an atom (or the set of hyperplane labels of an atom) or a list
+        of atoms.
+        """
+        D = self._data
+        if type(H) in [list, tuple]:
+            H = [D.elements[self._position(x)] for x in H]
         else:
-            def good_flats(F):
-                S = L[F]
-                if H in S:
-                    U = S.difference(Set([H]))
-                    return (U != 0) and (not U in L.values())
-                else:
-                    return True
-            flats = list(filter(good_flats, P._elements))
-            new_P = P.subposet(flats)
-            new_FL = {y : L[y].difference(Set([H])) for y in flats}
+            H = [D.elements[self._position(H)]]
+        assert all(D.rank(D.index[x]) == 1 for x in H), "Expected atoms."
+        h = 0
+        for x in H:
+            h |= D.masks[D.index[x]]
+
+        # Each flat S gives the flat S - H of the deletion, which is
+        # represented by the flat of least rank with the same remaining
+        # hyperplanes. The flats are sorted by rank, so this is the first one.
+        seen = set()
+        flats = []
+        for i in range(len(D)):
+            m = D.masks[i] & ~h
+            if not m in seen:
+                seen.add(m)
+                flats.append(i)
+        # The bits of the deleted hyperplanes are removed.
+        dead = sorted(_bits(h), reverse=True)
+        def prune(m):
+            for e in dead:
+                m = _drop_bit(m, e)
+            return m
+        masks = [prune(D.masks[i]) for i in flats]
+        hyperplanes = [D.hyperplanes[j] for j in range(len(D.hyperplanes)) if not (h >> j) & 1]
+        new_D = D.sub(flats, masks=masks, hyperplanes=hyperplanes)
 
         if self.hyperplane_arrangement:
             HPA = self.hyperplane_arrangement
             HL = self.hyperplane_labels
             A = list(HPA)
-            A.remove(HPA[H])
+            for x in H:
+                A.remove(HL[x])
             new_HPA = HPA.parent()(A)
-            new_HL = {x : HL[x] for x in new_P.upper_covers(new_P.bottom())}
+            new_HL = {x : HL[x] for x in map(lambda j: new_D.elements[j], new_D.atoms())}
         else:
             new_HPA = None
             new_HL = None
 
-        return LatticeOfFlats(new_HPA, poset=new_P, flat_labels=new_FL, hyperplane_labels=new_HL)
+        return LatticeOfFlats._from_data(new_D, A=new_HPA, hyperplane_labels=new_HL)
+
+    def add_hyperplane(self, H):
+        r"""
+        Return the lattice of flats of the arrangement with the hyperplane H
+        added; this is the inverse of ``deletion``. Only the flats contained
+        in H are computed. The output agrees with the lattice of flats of the
+        new arrangement, including the names of the elements and the
+        hyperplane labels.
+        """
+        HPA = self.hyperplane_arrangement
+        assert HPA != None, "Needs underlying hyperplane arrangement."
+        H = HPA.parent().ambient_space()(H)
+        new_HPA = HPA.parent()(list(HPA) + [H])
+        D, HL = _lof_add_hyperplane(self, H, new_HPA)
+        return LatticeOfFlats._from_data(D, A=new_HPA, hyperplane_labels=HL)
 
     def _lazy_restriction(self, H):
         HPA = self.hyperplane_arrangement
@@ -557,91 +1251,108 @@ class LatticeOfFlats():
         from sage.all import QQ, PolynomialRing
         PR = PolynomialRing(QQ, 'Y')
         Y = PR.gens()[0]
-        if self.poset != None:
-            P = self.poset 
-            atoms = self.atoms()
-            if P.rank() == 0:
-                return PR(1)
-            if P.rank() == 1:
-                return PR(1 + len(atoms)*Y)
-        else: 
-            # Lazy 
-            A = self.hyperplane_arrangement
-            assert A != None, "Expected either a poset or hyperplane arrangement."
-            if A.rank() == 0:
+        if self._interval != None:
+            # An interval of a lattice whose Poincare polynomials are cached.
+            D, i, upper = self._interval
+            U, L = D.poincare_arrays()
+            return PR([int(c) for c in (U[i] if upper else L[i])])
+        if self._data != None:
+            D = self._data
+            if D.rank() == 0:
                 return PR(1)
-            if A.rank() == 1:
-                return PR(1 + len(A)*Y)
-        if self.hyperplane_arrangement != None:
-            try: # Some hyperplane arrangements are bugged in SageMath.
-                D = self._lazy_deletion(1)
-                R = self._lazy_restriction(1)
-                return PR(D.Poincare_polynomial() + Y*R.Poincare_polynomial())
-            except: 
-                pass 
-        chi = self.poset.characteristic_polynomial()
-        q = chi.variables()[0]
-        d = chi.degree(q)
-        return PR((-Y)**d*chi.subs({q : -Y**-1}))
-        
-        
+            if D.rank() == 1:
+                return PR(1 + len(D.atoms())*Y)
+            return PR([int(c) for c in D.poincare_arrays()[0][0]])
+        A = self.hyperplane_arrangement
+        if A == None:
+            chi = self.poset.characteristic_polynomial()
+            q = chi.variables()[0]
+            d = chi.degree(q)
+            return PR((-Y)**d*chi.subs({q : -Y**-1}))
+
+        # Lazy
+        if A.rank() == 0:
+            return PR(1)
+        if A.rank() == 1:
+            return PR(1 + len(A)*Y)
+        key = _fingerprint(A)
+        pi = minor_cache.get(key)
+        if pi != None:
+            return PR(pi)
+        if _deletion_restriction_cost(A) <= _dr_limit:
+            D = self._lazy_deletion(1)
+            R = self._lazy_restriction(1)
+            pi = PR(D.Poincare_polynomial() + Y*R.Poincare_polynomial())
+        else:
+            pi = LatticeOfFlats(A).Poincare_polynomial()
+        minor_cache.save(key, pi)
+        return pi
+
+    def interval_Poincare_polynomial(self, x, upper=True):
+        r"""
+        Return the Poincare polynomial of the interval of elements above x if
+        upper is True, and of the interval [0, x] otherwise. The polynomials
+        of all intervals are computed in one pass and cached.
+        """
+        from sage.all import QQ, PolynomialRing
+        PR = PolynomialRing(QQ, 'Y')
+        D = self._data
+        U, L = D.poincare_arrays()
+        row = U[self._position(x)] if upper else L[self._position(x)]
+        return PR([int(c) for c in row])
+
     @cached_method
     def _combinatorial_eq_elts(self):
-        global POS, P_elts
         import sage.parallel.decorate as para
 
         N = _N
-        POS = self.poset
-        P_elts = self.proper_part_poset()._elements
+        D = self._data
+        top = D.top()
+        P_elts = [i for i in range(1, len(D)) if i != top]
+        interval_key = lambda i: tuple([
+            D.invariant(D.down_set(i)), D.invariant(D.up_set(i))
+        ])
+
+        # First we bucket the elements by cheap invariants of the intervals.
+        buckets = {}
+        for i in P_elts:
+            key = interval_key(i)
+            if key in buckets:
+                buckets[key].append(i)
+            else:
+                buckets[key] = [i]
+
+        # Canonical certificates are only needed for ambiguous buckets.
+        todo = [i for B in buckets.values() if len(B) > 1 for i in B]
 
         @para.parallel(N)
-        def match_elts(k, shift):
-            all_elts = P_elts[shift::k]
-            eq_elts = []
-            counts = []
-            down = []
-            restrict = []
-            while len(all_elts) > 0:
-                x = all_elts[0]
-                dow_x = self.subarrangement(x)
-                res_x = self.restriction(x)
-                match = False
-                i = 0
-                while not match and i < len(eq_elts):
-                    if dow_x.poset.is_isomorphic(down[i].poset) and res_x.poset.is_isomorphic(restrict[i].poset):
-                        match = True
-                    else:
-                        i += 1
-                if match:
-                    counts[i] += 1
+        def certify(elts):
+            cert = lambda i: tuple([
+                D.certificate(D.down_set(i)), D.certificate(D.up_set(i))
+            ])
+            return [tuple([i, cert(i)]) for i in elts]
+
+        certs = {}
+        if len(todo) > 0:
+            chunks = [tuple([todo[k::N]]) for k in range(N) if k < len(todo)]
+            certs = dict(_reduce(lambda x, y: x + y[1], certify(chunks), []))
+
+        # Group the elements by the pair (invariants, certificates).
+        classes = {}
+        for key, B in buckets.items():
+            for i in B:
+                c = tuple([key, certs.get(i)])
+                if c in classes:
+                    classes[c][1] += 1
                 else:
-                    eq_elts.append(x)
-                    counts.append(1)
-                    down.append(dow_x)
-                    restrict.append(res_x)
-                all_elts = all_elts[1:]
-            return list(zip(eq_elts, counts, down, restrict))
-
-        # Get the preliminary set of inequivalent elements
-        prelim_elts = list(match_elts([(N, k) for k in range(N)]))
-        prelim_elts = _reduce(lambda x, y: x + y[1], prelim_elts, [])
-
-        # Test further to minimize the size. 
+                    classes[c] = [i, 1]
+
         equiv_elts = []
-        while len(prelim_elts) > 0:
-            x = prelim_elts[0]
-            match = False
-            i = 0
-            while not match and i < len(equiv_elts):
-                if x[2].poset.is_isomorphic(equiv_elts[i][2].poset) and x[3].poset.is_isomorphic(equiv_elts[i][3].poset):
-                    match = True
-                else:
-                    i += 1
-            if match:
-                equiv_elts[i][1] += x[1]
-            else:
-                equiv_elts.append(list(x))
-            prelim_elts = prelim_elts[1:]
+        for i, count in sorted(classes.values()):
+            x = D.elements[i]
+            equiv_elts.append(
+                [x, count, self.subarrangement(x), self.restriction(x, geometric=False)]
+            )
         return equiv_elts
 
 
@@ -0,0 +1,246 @@
+#
+#   Copyright 2022 Joshua Maglione
+#
+#   Distributed under MIT License
+#
+
+from functools import reduce as _reduce
+from .Database import internal_database as _data
+from .Globals import __NCPUS as _N
+from .Globals import __PRINT as _print
+from .Globals import __TIME as _time
+from .CompactLattice import _popcount
+import random as _random
+import sage.parallel.decorate as _para
+
+# The reconstruction works with primes below 2^31, so that all residues fit in
+# a machine word. The primes used for verification are taken from a different
+# range, so they are never among the primes used for the reconstruction.
+_FIRST_PRIME = 2**31
+_CHECK_PRIME = 2**30
+
+# The number of primes after which the reconstruction gives up. Their product
+# exceeds 2^1900, far beyond the coefficients of any numerator we can compute.
+_MAX_PRIMES = 64
+
+# The generating functions are written in two variables X and Z with a known
+# denominator: the product of the factors 1 - X^a*Z^b over the given list of
+# pairs (a, b). For Igusa's zeta function X = q^-1 and Z = t, and there is one
+# factor for each distinct pair (rk x, |x|) of a nonzero flat x. Every flag of
+# flats has distinct ranks, so this is a multiple of the denominator of each
+# term of the recursion. For the coarse flag Hilbert--Poincare series X = Y,
+# Z = T, and the denominator is (1 - T)^rank.
+def _denominator(L, style):
+    D = L._data
+    if style == 'Igusa':
+        pairs = set(
+            (D.ranks[x], _popcount(D.masks[x])) for x in range(1, len(D))
+        )
+        return sorted(pairs)
+    return [(0, 1)]*D.rank()
+
+# Bounds on the degrees in X and Z of the numerator. Each term of the recursion
+# is a product of Poincare polynomials, of total degree at most the rank, and
+# of factors X^a*Z^b/(1 - X^a*Z^b).
+def _degree_bounds(L, pairs):
+    dX = L._data.rank() + sum(a for a, _ in pairs)
+    dZ = sum(b for _, b in pairs)
+    return dX, dZ
+
+def _den_value(pairs, a, b):
+    return _reduce(lambda x, y: x*y, [1 - a**i*b**j for i, j in pairs], 1)
+
+# The values of the generating function at the arrays X and Z.
+def _values(L, style, X, Z):
+    from .GenFunctions import _Igusa_zeta_values, _comb_skele_values
+    if style == 'Igusa':
+        return _Igusa_zeta_values(L, X**-1, Z, {})
+    return _comb_skele_values(L, X, Z, {})
+
+# Returns a random point (a, b) over the finite field F, avoiding the zeros of
+# the denominator.
+def _random_point(F, pairs):
+    p = F.characteristic()
+    while True:
+        x = F(_random.randrange(1, p))
+        y = F(_random.randrange(1, p))
+        if _den_value(pairs, x, y) != 0:
+            return x, y
+
+# Returns the coefficients of the numerator modulo p, as a dictionary from the
+# pairs of exponents (i, j) of X^i*Z^j to integers. The numerator is evaluated
+# on a grid of (dX + 1)*(dZ + 1) points and recovered by interpolation, first
+# in Z and then in X.
+def _numerator_mod(L, p, style, pairs, dX, dZ):
+    import numpy
+    from sage.all import GF, PolynomialRing
+    F = GF(p)
+
+    # The values of Z are chosen first, and the values of X are chosen so that
+    # the denominator does not vanish on the grid.
+    Zs = []
+    while len(Zs) < dZ + 1:
+        b = F(_random.randrange(1, p))
+        if not b in Zs and all(b**j != 1 for i, j in pairs if i == 0):
+            Zs.append(b)
+    Xs = []
+    while len(Xs) < dX + 1:
+        a = F(_random.randrange(1, p))
+        if not a in Xs and all(_den_value(pairs, a, b) != 0 for b in Zs):
+            Xs.append(a)
+
+    X = numpy.array([a for a in Xs for _ in Zs], dtype=object)
+    Z = numpy.array([b for _ in Xs for b in Zs], dtype=object)
+    vals = _values(L, style, X, Z)*_den_value(pairs, X, Z)
+
+    m = len(Zs)
+    RZ = PolynomialRing(F, 'Z')
+    rows = []
+    for k in range(len(Xs)):
+        f = RZ.lagrange_polynomial(list(zip(Zs, vals[k*m:(k + 1)*m])))
+        rows.append(f.padded_list(dZ + 1))
+    RX = PolynomialRing(F, 'X')
+    coeffs = {}
+    for j in range(dZ + 1):
+        g = RX.lagrange_polynomial(list(zip(Xs, [r[j] for r in rows])))
+        for i, c in enumerate(g.list()):
+            if c != 0:
+                coeffs[(i, j)] = int(c)
+    return coeffs
+
+# Parallel version of _numerator_mod, one prime per process. The processes are
+# forked, so the lattice is shared with the parent and not copied.
+@_para.parallel(_N)
+def _para_numerator_mod(L, p, style, pairs, dX, dZ):
+    return _numerator_mod(L, p, style, pairs, dX, dZ)
+
+# Lifts the residues modulo the given primes to integers by the Chinese
+# remainder theorem. The numerators have integer coefficients, so we take the
+# representatives of least absolute value (rational reconstruction with
+# denominator 1).
+def _lift(residues, moduli):
+    from sage.all import CRT_list, prod
+    M = prod(moduli)
+    keys = set().union(*residues)
+    N = {}
+    for k in keys:
+        c = CRT_list([R.get(k, 0) for R in residues], list(moduli))
+        if c > M // 2:
+            c -= M
+        if c != 0:
+            N[k] = c
+    return N
+
+# Checks N/denominator against the recursion at random points modulo a prime
+# that is not used for the reconstruction.
+def _verify(L, style, pairs, N, checks=4):
+    import numpy
+    from sage.all import GF, random_prime
+    F = GF(random_prime(_CHECK_PRIME, lbound=_CHECK_PRIME // 2))
+    pts = [_random_point(F, pairs) for _ in range(checks)]
+    X = numpy.array([a for a, _ in pts], dtype=object)
+    Z = numpy.array([b for _, b in pts], dtype=object)
+    vals = _values(L, style, X, Z)
+    for k in range(checks):
+        a, b = pts[k]
+        num = sum(F(c)*a**i*b**j for (i, j), c in N.items())
+        if num != vals[k]*_den_value(pairs, a, b):
+            return False
+    return True
+
+# Returns the numerator of the generating function as a dictionary from pairs
+# of exponents to integers. The numerator is computed modulo more and more
+# primes until its lift stabilizes and agrees with the recursion at random
+# points. Returns None if this does not happen within _MAX_PRIMES primes.
+def _reconstruct(L, style, pairs, verbose=_print):
+    from sage.all import previous_prime
+    dX, dZ = _degree_bounds(L, pairs)
+    if verbose:
+        print("{0}Interpolating on {1} points per prime".format(_time(), (dX + 1)*(dZ + 1)))
+
+    # The first prime is done here, so that the combinatorial data of all the
+    # lattices in the recursion is cached before the processes fork.
+    p = previous_prime(_FIRST_PRIME)
+    moduli = [p]
+    residues = [_numerator_mod(L, p, style, pairs, dX, dZ)]
+    N_old = _lift(residues, moduli)
+    while len(moduli) < _MAX_PRIMES:
+        batch = []
+        for _ in range(min(_N, _MAX_PRIMES - len(moduli))):
+            p = previous_prime(p)
+            batch.append(p)
+        inputs = [tuple([L, q, style, pairs, dX, dZ]) for q in batch]
+        for (args, _), R in _para_numerator_mod(inputs):
+            moduli.append(args[1])
+            residues.append(R)
+        N = _lift(residues, moduli)
+        if verbose:
+            print("{0}Primes used: {1}".format(_time(), len(moduli)))
+        if N == N_old and _verify(L, style, pairs, N):
+            return N
+        N_old = N
+    return None
+
+# Returns the numerator of Igusa's zeta function of L, as a polynomial in
+# u = q^-1 and t, and the list of pairs (a, b) of the factors 1 - q^-a*t^b of
+# the denominator. If the reconstruction gives up, the numerator is computed
+# exactly by the dp engine instead.
+def _Igusa_numerator_mod(L, verbose=_print):
+    from sage.all import PolynomialRing, ZZ
+    pairs = _denominator(L, 'Igusa')
+    N = _reconstruct(L, 'Igusa', pairs, verbose=verbose)
+    if N is None:
+        from .GenFunctions import _Igusa_numerator_dp
+        if verbose:
+            print("{0}Falling back to exact arithmetic".format(_time()))
+        return _Igusa_numerator_dp(L, verbose=verbose)
+    return PolynomialRing(ZZ, ['u', 't'])(N), pairs
+
+# Returns the numerator of the coarse flag Hilbert--Poincare series of L, as a
+# polynomial in Y and T, and the list of pairs (0, 1) of the factors 1 - T of
+# the denominator. If the reconstruction gives up, the numerator is computed
+# exactly by the dp engine instead.
+def _comb_skele_numerator_mod(L, verbose=_print):
+    from sage.all import PolynomialRing, ZZ
+    pairs = _denominator(L, 'skele')
+    N = _reconstruct(L, 'skele', pairs, verbose=verbose)
+    if N is None:
+        from .GenFunctions import _comb_skele_numerator_dp
+        if verbose:
+            print("{0}Falling back to exact arithmetic".format(_time()))
+        return _comb_skele_numerator_dp(L, verbose=verbose)
+    return PolynomialRing(ZZ, ['Y', 'T'])(N), pairs
+
+def _Igusa_zeta_function_mod(L, DB=True, verbose=_print, ring=None):
+    from .GenFunctions import _gen, _from_SR, _to_SR, _assemble
+    D = L._data
+    q = _gen(ring, 'q')
+    t = _gen(ring, 't')
+
+    if DB and D.rank() > 2:
+        zeta = _data.get_gen_func(D, 'Igusa')
+        if zeta != None:
+            return _from_SR(zeta, ring)
+
+    N, pairs = _Igusa_numerator_mod(L, verbose=verbose)
+    zeta = _assemble(N, pairs, q**-1, t)
+    if DB and D.rank() > 2:
+        _data.save_gen_func(D, 'Igusa', _to_SR(zeta))
+    return zeta
+
+def _comb_skele_mod(L, DB=True, verbose=_print, ring=None):
+    from .GenFunctions import _gen, _from_SR, _to_SR, _assemble
+    D = L._data
+    Y = _gen(ring, 'Y')
+    T = _gen(ring, 'T')
+
+    if DB and D.rank() > 2:
+        zeta = _data.get_gen_func(D, 'skele')
+        if zeta != None:
+            return _from_SR(zeta, ring)
+
+    N, pairs = _comb_skele_numerator_mod(L, verbose=verbose)
+    zeta = _assemble(N, pairs, Y, T)
+    if DB and D.rank() > 2:
+        _data.save_gen_func(D, 'skele', _to_SR(zeta))
+    return zeta
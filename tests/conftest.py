@@ -0,0 +1,47 @@
+#
+#   Copyright 2021 Joshua Maglione 
+#
+#   Distributed under MIT License
+#
+
+# Small central and affine arrangements shared by the tests. SageMath is only
+# imported when a fixture is used; the test modules are skipped without it.
+
+import pytest
+
+
+def _generic():
+    from sage.all import HyperplaneArrangements, QQ
+    H = HyperplaneArrangements(QQ, ('x', 'y', 'z'))
+    x, y, z = H.gens()
+    return H(x, y, z, x + y + z, x + 2*y, y - z)
+
+def _deleted_A3():
+    from hypigu import CoxeterArrangement
+    A = CoxeterArrangement("A3")
+    return A.parent()(list(A)[1:])
+
+def _Shi_A2():
+    from hypigu import ShiArrangement
+    return ShiArrangement("A2")
+
+def _Catalan_A2():
+    from hypigu import CatalanArrangement
+    return CatalanArrangement("A2")
+
+CENTRAL = {'generic' : _generic, 'A3 minus one' : _deleted_A3}
+AFFINE = {'Shi A2' : _Shi_A2, 'Catalan A2' : _Catalan_A2}
+ALL = dict(list(CENTRAL.items()) + list(AFFINE.items()))
+
+
+@pytest.fixture(params=sorted(CENTRAL))
+def central(request):
+    return CENTRAL[request.param]()
+
+@pytest.fixture(params=sorted(AFFINE))
+def affine(request):
+    return AFFINE[request.param]()
+
+@pytest.fixture(params=sorted(ALL))
+def arrangement(request):
+    return ALL[request.param]()
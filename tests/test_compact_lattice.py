@@ -0,0 +1,65 @@
+#
+#   Copyright 2021 Joshua Maglione 
+#
+#   Distributed under MIT License
+#
+
+import pytest
+
+sage = pytest.importorskip("sage.all")
+
+import hypigu as hi
+
+
+def test_poincare_row(arrangement):
+    L = hi.LatticeOfFlats(arrangement)
+    D = L._data
+    P = L.poset
+    for i in range(len(D)):
+        x = D.elements[i]
+        mu, row = D.poincare_row(i)
+        assert sorted(mu) == sorted(D.up_set(i))
+        for z in mu:
+            y = D.elements[z]
+            assert mu[z] == P.moebius_function(x, y)
+            coeffs = [0]*(D.ranks[z] - D.ranks[i] + 1)
+            for w in P.interval(x, y):
+                r = D.ranks[D.index[w]] - D.ranks[i]
+                coeffs[r] += (-1)**r*P.moebius_function(x, w)
+            assert list(row[z]) == coeffs
+
+
+def test_poincare_arrays(arrangement):
+    L = hi.LatticeOfFlats(arrangement)
+    D = L._data
+    P = L.poset
+    U, B = D.poincare_arrays()
+    bottom = D.elements[0]
+    for i in range(len(D)):
+        x = D.elements[i]
+        up = [0]*(D.rank() + 1)
+        for y in P.principal_upper_set(x):
+            r = D.ranks[D.index[y]] - D.ranks[i]
+            up[r] += (-1)**r*P.moebius_function(x, y)
+        assert list(U[i]) == up
+        down = [0]*(D.rank() + 1)
+        for y in P.interval(bottom, x):
+            r = D.ranks[D.index[y]]
+            down[r] += (-1)**r*P.moebius_function(bottom, y)
+        assert list(B[i]) == down
+    Y = L.Poincare_polynomial().parent().gen()
+    assert sum(c*Y**k for k, c in enumerate(U[0])) == L.Poincare_polynomial()
+
+
+def test_reachability(arrangement):
+    L = hi.LatticeOfFlats(arrangement)
+    D = L._data
+    P = L.poset
+    for i in range(len(D)):
+        x = D.elements[i]
+        below = sorted(D.index[y] for y in P.order_ideal([x]))
+        above = sorted(D.index[y] for y in P.order_filter([x]))
+        assert D.down_set(i) == below
+        assert D.up_set(i) == above
+        assert D.atoms_below(i) == [a for a in D.atoms() if a in below]
+        assert all(D.le(j, i) == (j in below) for j in range(len(D)))
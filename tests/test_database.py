@@ -0,0 +1,38 @@
+#
+#   Copyright 2021 Joshua Maglione 
+#
+#   Distributed under MIT License
+#
+
+import pytest
+
+sage = pytest.importorskip("sage.all")
+
+import hypigu as hi
+from hypigu.src.Database import IADatabase
+
+
+def test_disk_round_trip(tmp_path, central):
+    file = str(tmp_path / "hypigu.sqlite")
+    L = hi.LatticeOfFlats(central)
+    F = hi.CoarseFlagHPSeries(central)
+    IADatabase(file).save_gen_func(L._data, 'skele', F)
+
+    # A new session finds the series under an isomorphic lattice.
+    DB = IADatabase(file)
+    M = hi.LatticeOfFlats(poset=L.poset)
+    assert bool(DB.get_gen_func(M._data, 'skele') == F)
+    assert DB.get_gen_func(M._data, 'Igusa') is None
+    assert len(DB.poset_list) == 1
+
+
+def test_index_lookups(central):
+    L = hi.LatticeOfFlats(central)
+    DB = IADatabase()
+    assert DB.get_gen_func(L._data, 'skele') is None
+    DB.save_gen_func(L._data, 'skele', 1)
+    M = hi.LatticeOfFlats(poset=L.poset)
+    assert DB.get_gen_func(M._data, 'skele') == 1
+    assert DB.stats() == {'hits' : 1, 'misses' : 1}
+    N = L.deletion(L.atoms()[0])
+    assert DB.get_gen_func(N._data, 'skele') is None
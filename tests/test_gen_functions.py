@@ -0,0 +1,89 @@
+#
+#   Copyright 2021 Joshua Maglione 
+#
+#   Distributed under MIT License
+#
+
+import pytest
+from fractions import Fraction
+
+sage = pytest.importorskip("sage.all")
+
+import hypigu as hi
+
+# The engines compared against the symbolic engine for Igusa's zeta function
+# and the coarse flag Hilbert--Poincare series.
+ENGINES = ['rational', 'dp', 'modular']
+
+
+def _equal(F, G):
+    return bool((sage.SR(F) - sage.SR(G)).simplify_rational() == 0)
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+@pytest.mark.parametrize("f", [hi.IgusaZetaFunction, hi.CoarseFlagHPSeries])
+def test_engines_agree(arrangement, f, engine):
+    assert _equal(f(arrangement, engine=engine), f(arrangement))
+
+
+@pytest.mark.parametrize("f", [hi.TopologicalZetaFunction, hi.FlagHilbertPoincareSeries])
+def test_rational_engine(central, f):
+    assert _equal(f(central, engine='rational'), f(central))
+
+
+def test_Igusa_points(arrangement):
+    import numpy
+    q, t = sage.var('q t')
+    Z = hi.IgusaZetaFunction(arrangement)
+    points = [(2, 1), (3, sage.QQ(1)/2), (5, 7)]
+    exact = [sage.QQ(Z.subs({q : a, t : b})) for a, b in points]
+    assert hi.IgusaZetaFunction(arrangement, points=points) == exact
+    assert hi.IgusaZetaFunction(arrangement, points=numpy.array([[2, 1], [5, 7]])) == exact[::2]
+    approx = hi.IgusaZetaFunction(arrangement, points=points, base_ring=sage.RDF)
+    assert all(abs(a - b) < 1e-9*abs(b) for a, b in zip(approx, exact))
+
+
+def test_topological_points(central):
+    s = sage.var('s')
+    Z = hi.TopologicalZetaFunction(central)
+    points = [1, sage.QQ(1)/3, 4]
+    exact = [sage.QQ(Z.subs({s : a})) for a in points]
+    assert hi.TopologicalZetaFunction(central, points=points) == exact
+
+
+@pytest.mark.parametrize("engine", ['dp', 'modular'])
+def test_structured(arrangement, engine):
+    q, t, Y, T = sage.var('q t Y T')
+    G = hi.IgusaZetaFunction(arrangement, engine=engine, structured=True)
+    den = sage.prod(1 - q**-a*t**b for a, b in G.factors)
+    assert _equal(G.numerator_polynomial()(q**-1, t)/den, hi.IgusaZetaFunction(arrangement))
+    G = hi.CoarseFlagHPSeries(arrangement, engine=engine, structured=True)
+    N = G.numerator_polynomial()
+    assert all(p == (0, 1) for p in G.factors)
+    assert _equal(N(Y, T)/(1 - T)**len(G.factors), hi.CoarseFlagHPSeries(arrangement))
+    if arrangement.rank() > 2:
+        numer = hi.CoarseFlagHPSeries(arrangement, engine=engine, numerator=True)
+        assert _equal(numer, N(Y, T))
+        assert str(numer) == str(N(Y, T).factor())
+
+
+def test_generating_function(central):
+    q, t = sage.var('q t')
+    G = hi.IgusaZetaFunction(central, structured=True)
+    Z = hi.IgusaZetaFunction(central)
+    assert _equal(G.symbolic(), Z)
+    assert _equal(G.factor(), Z)
+    assert _equal(G.rational_function(), Z)
+    assert _equal((G*G).symbolic(), Z**2)
+    assert _equal((G**3).symbolic(), Z**3)
+    assert G**1 == G and G*G == G**2
+    assert _equal(G.monomial_substitution(b=2).symbolic(), Z.subs({t : t**2}))
+    assert _equal(sage.SR(G.subs({t : 3})), Z.subs({t : 3}))
+    assert G(5, sage.QQ(1)/2) == sage.QQ(Z.subs({q : 5, t : sage.QQ(1)/2}))
+    assert G(5, Fraction(1, 2)) == G(5, sage.QQ(1)/2)
+    assert G(5, Fraction(1, 2)).parent() is sage.QQ
+    N, den = G.numerator_denominator()
+    assert N == G.numerator_polynomial()
+    assert _equal(N(q**-1, t)/den(q**-1, t), Z)
+    with pytest.raises(ValueError):
+        G*hi.CoarseFlagHPSeries(central, structured=True)
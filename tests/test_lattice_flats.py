@@ -0,0 +1,262 @@
+#
+#   Copyright 2021 Joshua Maglione 
+#
+#   Distributed under MIT License
+#
+
+import pytest
+
+sage = pytest.importorskip("sage.all")
+
+import hypigu as hi
+
+
+def test_compact_lattice_agrees_with_sage(arrangement):
+    L = hi.LatticeOfFlats(arrangement)
+    assert L.poset.is_isomorphic(arrangement.intersection_poset())
+    assert len(L.atoms()) == len(arrangement)
+    Y = L.Poincare_polynomial().parent().gen()
+    assert L.Poincare_polynomial() == arrangement.poincare_polynomial()(Y)
+
+
+def test_flat_labels(arrangement):
+    L = hi.LatticeOfFlats(arrangement)
+    P = L.poset
+    for x in P:
+        below = [a for a in L.atoms() if P.le(a, x)]
+        assert len(L.flat_labels[x]) == len(below)
+
+
+def test_lazy_poset(arrangement):
+    L = hi.LatticeOfFlats(arrangement)
+    M = hi.LatticeOfFlats(poset=L.poset, lazy=True)
+    assert sorted(M.atoms()) == sorted(L.atoms())
+    assert len(M.proper_part_poset()) == len(L.proper_part_poset())
+    assert M.Poincare_polynomial() == L.Poincare_polynomial()
+
+
+def test_equivalent_flats(arrangement):
+    L = hi.LatticeOfFlats(arrangement)
+    P = L.proper_part_poset()
+    eq_elts = L._combinatorial_eq_elts()
+    assert sum(count for _, count, _, _ in eq_elts) == len(P)
+    for x, count, S, R in eq_elts:
+        same = lambda y: (
+            S.poset.is_isomorphic(L.subarrangement(y).poset) 
+            and R.poset.is_isomorphic(L.restriction(y).poset)
+        )
+        assert len([y for y in P if same(y)]) == count
+
+
+def _compact(L):
+    D = L._data
+    covers = [sorted(D.upper_covers(i)) for i in range(len(D))]
+    return list(D.ranks), list(D.masks), covers
+
+
+@pytest.mark.parametrize("engine", ['intersection', 'closure'])
+def test_engines_agree(arrangement, engine):
+    L = hi.LatticeOfFlats(arrangement, engine='matroid')
+    M = hi.LatticeOfFlats(arrangement, engine=engine)
+    assert _compact(M) == _compact(L)
+    assert M.hyperplane_labels == L.hyperplane_labels
+    assert M.flat_labels == L.flat_labels
+    with pytest.raises(ValueError):
+        hi.LatticeOfFlats(arrangement, engine='unknown')
+
+
+def test_build_next(arrangement):
+    from hypigu.src.LatticeFlats import build_next, _subspace_key
+    HS = [H._affine_subspace() for H in arrangement]
+    n = len(HS)
+    HYP = [sage.Set([k]) for k in range(n)]
+    data = build_next(HS, range(n), HYP, HS)
+    keys = [_subspace_key(I) for I, _, _ in data]
+    assert len(set(keys)) == len(keys)
+    rank2 = arrangement.intersection_poset().level_sets()[2]
+    assert len(data) == len(rank2)
+    for I, S, C in data:
+        assert C == set(S)
+        contain = lambda j: HS[j].intersection(I) == I
+        assert sorted(S) == [j for j in range(n) if contain(j)]
+
+
+@pytest.mark.parametrize("name", ['A3', 'B3'])
+def test_closure_engine(name):
+    A = hi.CoxeterArrangement(name)
+    for B in [A, hi.ShiArrangement(name)]:
+        L = hi.LatticeOfFlats(B, engine='matroid')
+        M = hi.LatticeOfFlats(B, engine='closure')
+        assert _compact(M) == _compact(L)
+
+
+def test_closure_modulo_prime(central):
+    import numpy
+    from hypigu.src.LatticeFlats import _closure_enumeration, _covering_flats
+    from hypigu.src.LatticeFlats import _covering_flats_mod
+    d = central.dimension()
+    V = [sage.vector(sage.QQ, H.coefficients()) for H in central]
+    e0 = sage.vector(sage.QQ, [1] + [0]*d)
+    p = 2**31 - 1
+    V_p = numpy.array([[int(a) % p for a in v] for v in V], dtype=numpy.int64)
+    e0_p = numpy.array([1] + [0]*d, dtype=numpy.int64)
+    def relations(result):
+        masks, covers = result
+        return sorted(masks), sorted((masks[x], masks[y]) for x, y in covers)
+    exact = _closure_enumeration(lambda F, B: _covering_flats(F, B, V, e0))
+    modular = _closure_enumeration(
+        lambda F, B: _covering_flats_mod(F, B, V_p, e0_p, p)
+    )
+    assert relations(modular) == relations(exact)
+
+
+def test_number_field_closure():
+    from hypigu.src.LatticeFlats import _number_field_vectors, _certify_ranks
+    A = hi.CoxeterArrangement("H3")
+    L = hi.LatticeOfFlats(A, engine='matroid')
+    M = hi.LatticeOfFlats(A, engine='closure')
+    assert _compact(M) == _compact(L)
+    assert M.hyperplane_labels == L.hyperplane_labels
+    V = [sage.vector(A.base_ring(), H.coefficients()) for H in A]
+    F, V_F = _number_field_vectors(A.base_ring(), V)
+    D = L._data
+    covers = [[i, j] for i in range(len(D)) for j in D.upper_covers(i)]
+    assert _certify_ranks(list(D.masks), covers, F, V_F)
+    assert not _certify_ranks([0, 2**len(A) - 1], [[0, 1]], F, V_F)
+
+
+def test_add_hyperplane(arrangement):
+    A = arrangement
+    n = len(A)
+    L = hi.LatticeOfFlats(A)
+    M = L.deletion(n).add_hyperplane(A[n - 1])
+    assert _compact(M) == _compact(L)
+    assert M.hyperplane_labels == L.hyperplane_labels
+    B = A.parent()(list(A)[1:])
+    M = hi.LatticeOfFlats(B).add_hyperplane(A[0])
+    assert _compact(M) == _compact(hi.LatticeOfFlats(B.parent()(list(B) + [A[0]])))
+    with pytest.raises(ValueError):
+        L.add_hyperplane(A[0])
+
+
+def test_deletion(arrangement):
+    A = arrangement
+    L = hi.LatticeOfFlats(A)
+    for H in [[1], [1, 3], list(range(2, len(A) + 1))]:
+        B = A.parent()([A[k - 1] for k in range(1, len(A) + 1) if not k in H])
+        M = L.deletion(H)
+        N = hi.LatticeOfFlats(B)
+        assert M.poset.is_isomorphic(N.poset)
+        assert M.Poincare_polynomial() == N.Poincare_polynomial()
+        HL = M.hyperplane_labels
+        assert len(HL) == len(B) and all(h in list(B) for h in HL.values())
+    assert L.deletion(2).poset.is_isomorphic(L.deletion([2]).poset)
+    for x in [len(L.poset) + 5, {len(A) + 5}]:
+        with pytest.raises(ValueError):
+            L.deletion(x)
+
+
+def test_minor_cache(arrangement):
+    from hypigu.src.LatticeFlats import minor_cache, _LRUCache
+    minor_cache.clear()
+    pi = hi.LatticeOfFlats(arrangement, lazy=True).Poincare_polynomial()
+    assert pi == hi.LatticeOfFlats(arrangement).Poincare_polynomial()
+    assert len(minor_cache) > 0
+    hits = minor_cache.stats()['hits']
+    assert hi.LatticeOfFlats(arrangement, lazy=True).Poincare_polynomial() == pi
+    assert minor_cache.stats()['hits'] == hits + 1
+    C = _LRUCache(2)
+    C.save('a', 1)
+    C.save('b', 2)
+    assert C.get('a') == 1
+    C.save('c', 3)
+    assert len(C) == 2 and C.get('b') is None and C.get('a') == 1
+
+
+def test_views(arrangement):
+    L = hi.LatticeOfFlats(arrangement)
+    D = L._data
+    P = L.poset
+    for i in range(1, len(D)):
+        x = D.elements[i]
+        S = L.subarrangement(x)
+        R = L.restriction(x)
+        assert S._size() == len(D.down_set(i))
+        assert R._size() == len(D.up_set(i))
+        assert S.poset.is_isomorphic(P.subposet(P.order_ideal([x])))
+        assert R.poset.is_isomorphic(P.subposet(P.order_filter([x])))
+        if len(D.upper_covers(i)) > 0:
+            B = R.hyperplane_arrangement
+            assert len(R.hyperplane_labels) == len(B)
+            pi = hi.LatticeOfFlats(B).Poincare_polynomial()
+            assert R.Poincare_polynomial() == pi
+        pi = hi.LatticeOfFlats(S.hyperplane_arrangement).Poincare_polynomial()
+        assert S.Poincare_polynomial() == pi
+
+
+def test_interval_cache(arrangement):
+    L = hi.LatticeOfFlats(arrangement)
+    x = L.atoms()[0]
+    assert L.interval_cache_stats() == {'hits' : 0, 'misses' : 0, 'size' : 0}
+    S = L.subarrangement(x)
+    R = L.restriction(x)
+    assert L.subarrangement(x) is S and L.restriction(x) is R
+    assert L.interval_cache_stats() == {'hits' : 2, 'misses' : 2, 'size' : 2}
+    for y, _, S, R in L._combinatorial_eq_elts():
+        assert L.subarrangement(y) is S and L.restriction(y) is R
+
+
+def test_restrictions(arrangement):
+    L = hi.LatticeOfFlats(arrangement)
+    M = hi.LatticeOfFlats(arrangement)
+    batch = L.restrictions()
+    assert sorted(batch) == sorted(L.poset)
+    for x, R in batch.items():
+        S = M.restriction(x)
+        assert R.poset.is_isomorphic(S.poset)
+        if len(S.atoms()) > 0:
+            assert sorted(R.hyperplane_labels) == sorted(S.hyperplane_labels)
+            pi = hi.LatticeOfFlats(R.hyperplane_arrangement).Poincare_polynomial()
+            assert pi == S.Poincare_polynomial()
+    X = L.atoms()[:2]
+    assert sorted(L.restrictions(X)) == sorted(X)
+    x = X[0]
+    R = M.restriction(x)
+    B = M.restrictions([x])[x]
+    assert B is not R
+    assert M.restrictions([x])[x] is B and M.restriction(x) is R
+
+
+def test_combinatorial_restriction(arrangement):
+    L = hi.LatticeOfFlats(arrangement)
+    for x in L.poset:
+        R = L.restriction(x, geometric=False)
+        S = L.restriction(x)
+        assert R.hyperplane_arrangement is None
+        assert R.poset.is_isomorphic(S.poset)
+        assert R.Poincare_polynomial() == S.Poincare_polynomial()
+        assert L.restriction(x, geometric=False) is R
+
+
+def test_fingerprint():
+    from hypigu.src.LatticeFlats import _fingerprint
+    A = hi.CoxeterArrangement("A2")
+    H = A.parent()
+    B = H([2*K for K in reversed(list(A))])
+    assert _fingerprint(A) == _fingerprint(B)
+    x, y, z = H.gens()
+    C = H(x, y, x + y)
+    assert C.intersection_poset().is_isomorphic(A.intersection_poset())
+    assert _fingerprint(A) != _fingerprint(C)
+
+
+def test_closure_certificate(central):
+    from hypigu.src.LatticeFlats import _certify_ranks
+    H = sage.HyperplaneArrangements(sage.QQ, ('x', 'y'))
+    L = hi.LatticeOfFlats(H(), engine='closure')
+    assert len(L._data) == 1 and L.Poincare_polynomial() == 1
+    V = [sage.vector(sage.QQ, K.coefficients()) for K in central]
+    D = hi.LatticeOfFlats(central, engine='closure')._data
+    covers = [[i, j] for i in range(len(D)) for j in D.upper_covers(i)]
+    assert _certify_ranks(list(D.masks), covers, sage.QQ, V)
+    assert not _certify_ranks([0, 2**len(V) - 1], [[0, 1]], sage.QQ, V)
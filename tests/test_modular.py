@@ -0,0 +1,49 @@
+#
+#   Copyright 2022 Joshua Maglione
+#
+#   Distributed under MIT License
+#
+
+import pytest
+
+sage = pytest.importorskip("sage.all")
+
+import hypigu as hi
+from hypigu.src.Modular import _denominator, _lift, _reconstruct
+from hypigu.src.Modular import _Igusa_numerator_mod, _comb_skele_numerator_mod
+from hypigu.src.GenFunctions import _Igusa_numerator_dp, _comb_skele_numerator_dp
+
+
+def test_lift():
+    moduli = [7, 11, 13]
+    N = {(0, 0) : 5, (1, 2) : -200, (3, 1) : 499, (2, 2) : 0}
+    residues = [{k : c % p for k, c in N.items()} for p in moduli]
+    assert _lift(residues, moduli) == {k : c for k, c in N.items() if c != 0}
+
+
+@pytest.mark.parametrize("style", ['Igusa', 'skele'])
+@pytest.mark.parametrize("name", ['A3', 'B3'])
+def test_reconstruct(name, style):
+    A = hi.CoxeterArrangement(name)
+    L = hi.LatticeOfFlats(A)
+    pairs = _denominator(L, style)
+    N = _reconstruct(L, style, pairs)
+    if style == 'Igusa':
+        q, t = sage.var('q t')
+        X, Z = q**-1, t
+        F = hi.IgusaZetaFunction(A)
+    else:
+        X, Z = sage.var('Y T')
+        F = hi.CoarseFlagHPSeries(A)
+    num = sum(c*X**i*Z**j for (i, j), c in N.items())
+    den = sage.prod(1 - X**a*Z**b for a, b in pairs)
+    assert bool((num/den - F).simplify_rational() == 0)
+
+
+def test_prime_cap(monkeypatch):
+    import hypigu.src.Modular as Modular
+    L = hi.LatticeOfFlats(hi.CoxeterArrangement("A3"))
+    monkeypatch.setattr(Modular, "_MAX_PRIMES", 1)
+    assert _reconstruct(L, 'Igusa', _denominator(L, 'Igusa')) is None
+    assert _Igusa_numerator_mod(L) == _Igusa_numerator_dp(L)
+    assert _comb_skele_numerator_mod(L) == _comb_skele_numerator_dp(L)